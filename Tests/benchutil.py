@@ -0,0 +1,81 @@
+'''
+Timing helpers and stand-ins for the server shared by the benchmarks and tests.
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from match import Match
+
+def timeCall(func, number, repeat=5):
+    # best seconds per call out of repeat runs
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def report(name, seconds, unit="us", scale=1e6):
+    print("  {0:<28} {1:12.3f} {2}/call".format(name, seconds * scale, unit))
+
+def compare(title, old, new, number, repeat=5, unit="us", scale=1e6):
+    # old and new are (name, func); prints both timings and the speedup
+    print(title)
+    a = timeCall(old[1], number, repeat)
+    report(old[0], a, unit, scale)
+    b = timeCall(new[1], number, repeat)
+    report(new[0], b, unit, scale)
+    print("  speedup: {0:.2f}x".format(a / b))
+    return a, b
+
+def importServer():
+    # server.py sends stdout to the twisted log when imported, put it back for the report
+    stdout = sys.stdout
+    import server
+    sys.stdout = stdout
+    return server
+
+class FakeFactory:
+    # MyServerFactory with just the settings and counters a test sets up
+    def __init__(self, **attrs):
+        self.in_messages = 0
+        self.out_messages = 0
+        self.compressionThreshold = 0
+        self.outboxTimer = None
+        self.playerListDeltas = False
+        self.defaultName = "INFRINGIO"
+        self.interestRadius = 0
+        self.interestFarRate = 0
+        self.__dict__.update(attrs)
+
+def makeMatch(server, cls=Match, **attrs):
+    # A match without Match.__init__, so no level and no timers, with the empty player
+    # bookkeeping of a new one. Players still have to be added or indexed.
+    match = cls.__new__(cls)
+    match.server = server
+    match.lastId = -1
+    match.players = []
+    match.playersById = {}
+    match.zonePlayers = {}
+    match.podiumPlayers = set()
+    match.playerListVersion = 0
+    match.playerListDeltas = server.playerListDeltas
+    match.playerListAdded = {}
+    match.playerListRemoved = []
+    match.playerListUpdated = {}
+    match.zoneGrids = {}
+    match.gridSize = server.interestRadius
+    match.__dict__.update(attrs)
+    return match
+
+class FakeMatch:
+    closed = False
+    playing = False
+
+class FakePlayer:
+    # a loaded player in a match that isn't running, records the packets it handles
+    def __init__(self):
+        self.loaded = True
+        self.match = FakeMatch()
+        self.packets = []
+
+    def handlePkt(self, code, fields, pktData):
+        self.packets.append((code, fields))
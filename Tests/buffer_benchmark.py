@@ -0,0 +1,69 @@
+'''
+Benchmark for Buffer reads alone: a growing number of coalesced UPDATE_PLAYER_OBJECT
+(0x12) bodies are decoded field by field with the cursor based Buffer and with the
+pop(0)/del reader it replaced, plus a string read and toBytes() on one packet.
+'''
+
+import struct
+
+from benchutil import timeCall
+from buffer import Buffer
+
+FRAMES = [1, 16, 256, 4096, 16384]
+
+# buffer.Buffer before the cursor: every read shifted the remaining bytes out
+class PopBuffer:
+    def __init__(self, data):
+        self.buffer = data
+
+    def read(self, length=1):
+        data = self.buffer[:length]
+        del self.buffer[:length]
+        return data
+
+    def readInt8(self):
+        return self.buffer.pop(0)
+
+    def readInt16(self):
+        return self.readInt8() << 8 | self.readInt8() << 0
+
+    def readBool(self):
+        return self.buffer.pop(0) == 1
+
+    def readVec2(self):
+        return struct.unpack("!ff", self.read(8))
+
+    def readString(self):
+        return self.read(self.readInt16())
+
+    def toBytes(self):
+        return bytes(self.buffer)
+
+# level, zone, pos, sprite, reverse - the body of a 0x12 packet
+packet = bytes([0, 1]) + struct.pack("!ff", 35.5, 3.25) + bytes([2, 0])
+string = struct.pack("!H", 20) + b"INFRINGIO" * 2 + b"!!"
+
+def decodeAll(b, count):
+    for i in range(count):
+        b.readInt8(), b.readInt8(), b.readVec2(), b.readInt8(), b.readBool()
+
+def decodeOne(cls):
+    b = cls(bytearray(packet + string))
+    b.readInt8(), b.readInt8(), b.readVec2(), b.readInt8(), b.readBool()
+    return b.readString(), b.toBytes()
+
+if __name__ == '__main__':
+    assert decodeOne(PopBuffer) == decodeOne(Buffer)
+    print("one 0x12 body, a string and toBytes():")
+    a = timeCall(lambda: decodeOne(PopBuffer), 100000)
+    b = timeCall(lambda: decodeOne(Buffer), 100000)
+    print("  pop(0) {0:.3f} us, cursor {1:.3f} us, speedup {2:.2f}x".format(a * 1e6, b * 1e6, a / b))
+
+    print("coalesced 0x12 bodies read from one buffer:")
+    print("  {0:>6} {1:>15} {2:>15} {3:>9}".format("frames", "pop(0) us/frame", "cursor us/frame", "speedup"))
+    for count in FRAMES:
+        data = packet * count
+        number = max(5, 50000 // count)
+        a = timeCall(lambda: decodeAll(PopBuffer(bytearray(data)), count), number) / count
+        b = timeCall(lambda: decodeAll(Buffer(data), count), number) / count
+        print("  {0:>6} {1:15.3f} {2:15.3f} {3:8.2f}x".format(count, a * 1e6, b * 1e6, a / b))
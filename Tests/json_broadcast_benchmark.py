@@ -0,0 +1,54 @@
+'''
+Benchmark for Match.broadJSON to a full 75 player match, run through the real players
+and protocol send path, serializing once per broadcast versus once per recipient as
+broadJSON did before.
+'''
+
+from benchutil import FakeFactory, compare, importServer, makeMatch
+from match import Match
+from player import Player
+
+server = importServer()
+
+PLAYERS = 75
+
+class Client(server.MyServerProtocol):
+    def __init__(self, factory):
+        server.MyServerProtocol.__init__(self, factory)
+        self._perMessageCompress = None
+        self.sent = 0
+
+    def sendMessage(self, payload, isBinary=False, doNotCompress=False):
+        self.sent += len(payload)
+
+# encodes the message again for every loaded player
+class PerRecipientMatch(Match):
+    def broadJSON(self, j):
+        for player in self.players:
+            if not player.loaded:
+                continue
+            player.sendJSON(j)
+
+def makeFullMatch(cls):
+    factory = FakeFactory()
+    match = makeMatch(factory, cls)
+    for i in range(PLAYERS):
+        player = Player(Client(factory), "PLAYER" + str(i), "", match, 0, 0, False)
+        player.loaded = True
+    return match
+
+tick = {"type":"gtk", "ticks":25, "votes":3, "minPlayers":2, "maxPlayers":PLAYERS, "voteRateToStart":0.85}
+playerList = {"packets": [
+    {"players": [{"id": i, "name": "PLAYER"+str(i), "team": "", "isDev": False, "isGuest": i % 2 == 0} for i in range(PLAYERS)],
+     "type": "g12"}
+], "type": "s01"}
+
+if __name__ == '__main__':
+    old = makeFullMatch(PerRecipientMatch)
+    new = makeFullMatch(Match)
+    old.broadJSON(playerList)
+    new.broadJSON(playerList)
+    assert [p.client.sent for p in old.players] == [p.client.sent for p in new.players]
+    for name, j, number in [("gtk", tick, 2000), ("g12", playerList, 200)]:
+        compare("broadJSON {0} to {1} players".format(name, PLAYERS),
+            ("per recipient", lambda: old.broadJSON(j)), ("shared", lambda: new.broadJSON(j)), number)
@@ -0,0 +1,79 @@
+'''
+Reactor latency during a burst of logins against a throwaway sqlite database, with
+argon2 run on the reactor thread (no hash pool) and in the hash pool. A 10 ms timer
+measures how late the reactor gets to it while the burst is in progress.
+
+usage: python login_burst_benchmark.py [logins]
+'''
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from twisted.internet import task, defer
+import datastore
+
+LOGINS = 500
+TICK = 0.01
+
+class LatencyProbe:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.lateness = []
+        self.last = None
+        self.loop = task.LoopingCall(self.tick)
+
+    def start(self):
+        self.last = time.perf_counter()
+        self.loop.start(TICK, now=False)
+
+    def tick(self):
+        now = time.perf_counter()
+        self.lateness.append(max(0, now - self.last - TICK))
+        self.last = now
+
+    def stop(self):
+        self.loop.stop()
+        lateness = sorted(self.lateness) or [0]
+        return lateness[len(lateness) * 99 // 100], lateness[-1]
+
+@defer.inlineCallbacks
+def burst(reactor, name, count):
+    probe = LatencyProbe(reactor)
+    probe.start()
+    start = time.perf_counter()
+    results = yield defer.gatherResults([datastore.login("BENCH", "password123") for i in range(count)])
+    elapsed = time.perf_counter() - start
+    p99, worst = probe.stop()
+    ok = sum(1 for status, msg, priv in results if status)
+    busy = sum(1 for status, msg, priv in results if msg == datastore.BUSY_MSG)
+    print("{0:<20} {1:8.2f} s  p99 {2:8.1f} ms  max {3:8.1f} ms  ok {4}  busy {5}".format(
+        name, elapsed, p99 * 1000, worst * 1000, ok, busy))
+
+@defer.inlineCallbacks
+def main(reactor, count):
+    # the hash pool has to start before any database handle is open
+    datastore.startHashPool(0, count)
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    datastore.openDb("sqlite:///" + path)
+    datastore.openSessions(":memory:", 3600)
+    datastore.startPool(8)
+    status, msg, priv = yield datastore.register("BENCH", "password123")
+    assert status, msg
+
+    yield burst(reactor, "hash pool", count)
+    datastore.maxHashQueue = 64
+    yield burst(reactor, "hash pool, queue 64", count)
+    datastore.stopHashPool()
+    yield burst(reactor, "reactor thread", count)
+    datastore.stopPool()
+    os.remove(path)
+
+if __name__ == '__main__':
+    if datastore.ph is None:
+        sys.exit("argon2-cffi is required")
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else LOGINS
+    print("{0} logins, {1} cpus".format(count, os.cpu_count()))
+    task.react(main, [count])
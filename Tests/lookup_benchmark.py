@@ -0,0 +1,87 @@
+'''
+Scaling benchmark for the server lookup tables at 10k connected users, run through the
+real code: the llg handler of MyServerProtocol (loginBlocked and authd checks),
+Match.getPlayer and the expiry of login blocks. Each is compared with the list based
+version it replaced.
+'''
+
+import heapq
+
+from benchutil import FakeFactory, compare, importServer, makeMatch
+from twisted.internet import task
+import util
+from match import Match
+
+server = importServer()
+
+USERS = 10000
+
+class FakePlayer:
+    def __init__(self, pid):
+        self.id = pid
+
+# walks the player list for each pid, there was no playersById
+class ScanMatch(Match):
+    def getPlayer(self, pid):
+        for player in self.players:
+            if player.id == pid:
+                return player
+        return None
+
+def makeProtocol(factory):
+    p = server.MyServerProtocol(factory)
+    p.address = "192.168.0.1"
+    p.stat = p.pendingStat = "l"
+    p.sendJSON = lambda j: None
+    return p
+
+def makeFullMatch(cls, players):
+    match = makeMatch(FakeFactory(), cls)
+    for player in players:
+        player.id = match.addPlayer(player)
+    return match
+
+if __name__ == '__main__':
+    names = ["USER%d" % i for i in range(USERS)]
+    addresses = ["10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF) for i in range(USERS)]
+    # the last user logging in again from an address that isn't blocked
+    llg = '{"type": "llg", "username": "user%d", "password": "password123"}' % (USERS - 1)
+
+    clock = task.Clock()
+    blocked = util.ExpiringSet(60, clock=clock)
+    for address in addresses:
+        blocked.add(address)
+    old = makeProtocol(FakeFactory(authd=list(names), loginBlocked=list(addresses)))
+    new = makeProtocol(FakeFactory(authd=set(names), loginBlocked=blocked))
+    compare("llg of a logged in user with 10k users and 10k blocked addresses",
+        ("lists", lambda: old.onTextMessage(llg)), ("set, ExpiringSet", lambda: new.onTextMessage(llg)), 200)
+    blocked.stop()
+
+    scan = makeFullMatch(ScanMatch, [FakePlayer(0) for i in range(USERS)])
+    indexed = makeFullMatch(Match, [FakePlayer(0) for i in range(USERS)])
+    assert scan.getPlayer(USERS - 1) is scan.players[-1] and indexed.getPlayer(USERS - 1) is indexed.players[-1]
+    compare("Match.getPlayer of the last pid", ("scan", lambda: scan.getPlayer(USERS - 1)), ("playersById", lambda: indexed.getPlayer(USERS - 1)), 1000)
+
+    def blockList():
+        # the old code appended to a list and removed each address from a callLater; the
+        # reactor keeps those in a heap, task.Clock would re-sort on every callLater
+        calls = []
+        blocked = []
+        for address in addresses:
+            blocked.append(address)
+            heapq.heappush(calls, (60, address))
+        hits = sum(1 for address in addresses[:100] if address in blocked)
+        while calls:
+            blocked.remove(heapq.heappop(calls)[1])
+        return hits, len(blocked)
+    def blockWheel():
+        clock = task.Clock()
+        blocked = util.ExpiringSet(60, clock=clock)
+        for address in addresses:
+            blocked.add(address)
+        hits = sum(1 for address in addresses[:100] if address in blocked)
+        clock.pump([1] * 60)
+        blocked.stop()
+        return hits, len(blocked)
+    assert blockList() == blockWheel() == (100, 0)
+    compare("block, check and expire 10k addresses", ("list", blockList), ("ExpiringSet", blockWheel), 1, 3, "ms", 1e3)
@@ -0,0 +1,78 @@
+'''
+Simulates a burst of 10k joins across game modes, public matches and a few hundred
+private rooms, and compares the old linear scan in getMatch with MatchDirectory.
+'''
+
+import random
+
+from benchutil import compare
+from matchdirectory import MatchDirectory
+
+JOINS = 10000
+MODES = ["royale", "pvp", "hell"]
+ROOMS = ["room%d" % i for i in range(500)]
+
+class FakeServer:
+    playerCap = 75
+    allowLateEnter = False
+
+class FakeMatch:
+    def __init__(self, roomName, private, gameMode):
+        self.roomName = roomName
+        self.private = private
+        self.gameMode = gameMode
+        self.closed = False
+        self.playing = False
+        self.players = []
+
+# the loop getMatch ran over every open match on each join
+class LinearMatches:
+    def __init__(self, server):
+        self.server = server
+        self.matches = []
+
+    def find(self, roomName, private, gameMode):
+        for match in self.matches:
+            if not match.closed and len(match.players) < self.server.playerCap and gameMode == match.gameMode and private == match.private and (not private or match.roomName == roomName):
+                if not self.server.allowLateEnter and match.playing:
+                    continue
+                return match
+        return None
+
+    def add(self, match):
+        self.matches.append(match)
+
+def makeJoins():
+    rng = random.Random(1)
+    joins = []
+    for i in range(JOINS):
+        if rng.random() < 0.3:
+            joins.append((rng.choice(ROOMS), True, rng.choice(MODES)))
+        else:
+            joins.append(("", False, rng.choice(MODES)))
+    return joins
+
+def simulate(directory, joins):
+    placed = []
+    created = 0
+    for roomName, private, gameMode in joins:
+        match = directory.find(roomName, private, gameMode)
+        if match is None:
+            match = FakeMatch(roomName, private, gameMode)
+            match.index = created
+            created += 1
+            directory.add(match)
+        match.players.append(len(placed))
+        if len(match.players) >= FakeServer.playerCap // 2 and not match.private:
+            # public matches start once they are half full, like an autostart would
+            match.playing = True
+            match.closed = True
+        placed.append(match.index)
+    return placed
+
+if __name__ == '__main__':
+    joins = makeJoins()
+    assert simulate(LinearMatches(FakeServer()), joins) == simulate(MatchDirectory(FakeServer()), joins)
+    compare("{0} joins".format(len(joins)),
+        ("linear scan", lambda: simulate(LinearMatches(FakeServer()), joins)),
+        ("MatchDirectory", lambda: simulate(MatchDirectory(FakeServer()), joins)), 1, 3, "ms", 1e3)
@@ -0,0 +1,79 @@
+'''
+Scaling benchmark for the binary receive path: websocket messages carrying a growing
+number of coalesced UPDATE_PLAYER_OBJECT (0x12) frames go through the real
+MyServerProtocol.onMessage and onBinaryMessage, against the old loop that re-sliced
+self.recv and read each frame with pop(0)/del. Each message is also delivered split in
+two mid-frame, so the partial tail kept in self.recv is exercised.
+'''
+
+import struct
+
+from benchutil import FakeFactory, FakePlayer, timeCall, importServer
+from buffer_benchmark import PopBuffer
+
+server = importServer()
+
+FRAMES = [1, 16, 256, 4096]
+
+class Player(FakePlayer):
+    # the old path handed over a reader, Player.handlePkt decoded the fields from it
+    def handlePkt(self, code, fields, pktData):
+        if isinstance(fields, PopBuffer):
+            fields = fields.readInt8(), fields.readInt8(), fields.readVec2(), fields.readInt8(), fields.readBool()
+        self.packets.append(code)
+
+# appends every payload to recv, then copies out and front-deletes one packet at a time
+class PopProtocol(server.MyServerProtocol):
+    pktLenDict = { 0x10: 6, 0x11: 0, 0x12: 12, 0x13: 1, 0x17: 2, 0x18: 4, 0x19: 0, 0x20: 7, 0x30: 7 }
+
+    def onMessage(self, payload, isBinary):
+        self.recv += payload
+        while len(self.recv) > 0:
+            if not self.onBinaryMessage():
+                break
+
+    def onBinaryMessage(self):
+        code = self.recv[0]
+        if code not in self.pktLenDict:
+            self.recv.clear()
+            return False
+        pktLen = self.pktLenDict[code] + 1
+        if len(self.recv) < pktLen:
+            return False
+        b = PopBuffer(self.recv[1:pktLen])
+        del self.recv[:pktLen]
+        if self.player is None or not self.player.loaded or self.blocked or (not self.player.match.closed and self.player.match.playing):
+            self.recv.clear()
+            return False
+        self.player.handlePkt(code, b, b.toBytes())
+        return True
+
+def makeProtocol(cls):
+    p = cls(FakeFactory())
+    p.player = Player()
+    return p
+
+# level, zone, pos, sprite, reverse
+frame = bytes([0x12, 0, 1]) + struct.pack("!ff", 35.5, 3.25) + bytes([2, 0])
+
+def receive(p, messages):
+    for message in messages:
+        p.onMessage(message, True)
+
+if __name__ == '__main__':
+    for split in (False, True):
+        print("{0} coalesced 0x12 frames per message:".format("split" if split else "whole"))
+        print("  {0:>6} {1:>14} {2:>14} {3:>9}".format("frames", "pop(0) us/frame", "offset us/frame", "speedup"))
+        for count in FRAMES:
+            payload = frame * count
+            half = len(payload) // 2 + 1 # in the middle of a frame
+            messages = [payload[:half], payload[half:]] if split else [payload]
+            old = makeProtocol(PopProtocol)
+            new = makeProtocol(server.MyServerProtocol)
+            receive(old, messages)
+            receive(new, messages)
+            assert len(old.player.packets) == len(new.player.packets) == count and len(old.recv) == len(new.recv) == 0
+            number = max(20, 50000 // count)
+            a = timeCall(lambda: receive(old, messages), number) / count
+            b = timeCall(lambda: receive(new, messages), number) / count
+            print("  {0:>6} {1:14.3f} {2:14.3f} {3:8.2f}x".format(count, a * 1e6, b * 1e6, a / b))
@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from banlist import BanList
+
+class BanListTest(unittest.TestCase):
+    def test_plain_addresses(self):
+        bans = BanList([["1.2.3.4", "", ""], ["::1", "", ""]])
+        self.assertIn("1.2.3.4", bans)
+        self.assertIn("::1", bans)
+        self.assertNotIn("1.2.3.5", bans)
+        self.assertNotIn("0:0:0:0:0:0:0:2", bans)
+
+    def test_ipv4_ranges(self):
+        bans = BanList([["10.1.0.0/16", "", ""], ["192.168.5.7/24", "", ""], ["8.8.8.8/32", "", ""]])
+        self.assertIn("10.1.0.0", bans)
+        self.assertIn("10.1.255.255", bans)
+        self.assertNotIn("10.2.0.0", bans)
+        self.assertNotIn("10.0.255.255", bans)
+        # host bits in the entry are ignored
+        self.assertIn("192.168.5.200", bans)
+        self.assertNotIn("192.168.6.1", bans)
+        self.assertIn("8.8.8.8", bans)
+        self.assertNotIn("8.8.8.9", bans)
+
+    def test_ipv6_ranges(self):
+        bans = BanList([["2001:db8::/32", "", ""]])
+        self.assertIn("2001:db8:ffff::1", bans)
+        self.assertNotIn("2001:db9::1", bans)
+
+    def test_versions_do_not_mix(self):
+        bans = BanList([["0.0.0.0/8", "", ""], ["::/8", "", ""]])
+        self.assertIn("0.1.2.3", bans)
+        self.assertIn("::ffff", bans)
+        self.assertNotIn("1.0.0.0", bans)
+        self.assertNotIn("100::", bans)
+
+    def test_invalid_entries_and_addresses(self):
+        bans = BanList([["not/an address", "", ""], ["10.0.0.0/8", "", ""]])
+        self.assertIn("not/an address", bans)
+        self.assertNotIn("garbage", bans)
+        self.assertNotIn("", bans)
+        self.assertEqual(len(bans), 2)
+        self.assertEqual(bans.toList()[0], ["not/an address", "", ""])
+
+if __name__ == '__main__':
+    unittest.main()
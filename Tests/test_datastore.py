@@ -0,0 +1,123 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from twisted.internet import defer
+from twisted.trial import unittest
+import datastore
+
+PASSWORD = "password123"
+
+class AccountTest(unittest.TestCase):
+    # login, register, resume and profile updates against an in-memory sqlite database,
+    # with argon2 run inline since no hash pool is started
+    def setUp(self):
+        if datastore.ph is None:
+            raise unittest.SkipTest("argon2-cffi is required")
+        datastore.openDb("sqlite:///:memory:")
+        datastore.openSessions(":memory:", 3600)
+        datastore.accountCache = datastore.AccountCache(100, 60)
+        datastore.startPool(2)
+        self.addCleanup(datastore.stopPool)
+
+    @defer.inlineCallbacks
+    def test_register_and_login(self):
+        status, msg, priv = yield datastore.register("ALICE", PASSWORD)
+        self.assertTrue(status)
+        self.assertEqual(msg["nickname"], "ALICE")
+        self.assertIn("session", msg)
+        self.assertEqual(priv, {"id": 1, "isBanned": False})
+
+        status, msg, priv = yield datastore.register("ALICE", PASSWORD)
+        self.assertEqual((status, msg), (False, "account already registered"))
+
+        status, msg, priv = yield datastore.login("ALICE", PASSWORD)
+        self.assertTrue(status)
+        self.assertEqual(msg["username"], "ALICE")
+
+        status, msg, priv = yield datastore.login("ALICE", "wrongpassword")
+        self.assertEqual((status, msg), (False, "invalid user name or password"))
+        status, msg, priv = yield datastore.login("NOBODY", PASSWORD)
+        self.assertEqual((status, msg), (False, "invalid user name or password"))
+
+    @defer.inlineCallbacks
+    def test_register_checks_input(self):
+        status, msg, priv = yield datastore.register("AB", PASSWORD)
+        self.assertEqual(msg, "username too short")
+        status, msg, priv = yield datastore.register("ALICE!", PASSWORD)
+        self.assertEqual(msg, "illegal character in username")
+        status, msg, priv = yield datastore.register("ALICE", "short")
+        self.assertEqual(msg, "password too short")
+        self.assertEqual(datastore.hashQueue, 0)
+
+    @defer.inlineCallbacks
+    def test_resume_and_logout(self):
+        status, msg, priv = yield datastore.register("ALICE", PASSWORD)
+        token = msg["session"]
+        status, msg, priv = yield datastore.defer(datastore.resumeSession, token)
+        self.assertTrue(status)
+        self.assertEqual((msg["username"], msg["session"]), ("ALICE", token))
+
+        status, msg, priv = yield datastore.defer(datastore.resumeSession, "nosuchtoken")
+        self.assertEqual((status, msg), (False, "session expired, please log in"))
+
+        yield datastore.logout(token)
+        status, msg, priv = yield datastore.defer(datastore.resumeSession, token)
+        self.assertFalse(status)
+
+    @defer.inlineCallbacks
+    def test_update_account(self):
+        yield datastore.register("ALICE", PASSWORD)
+        yield datastore.register("BOBBY", PASSWORD)
+        status, msg, priv = yield datastore.login("ALICE", PASSWORD)
+        token = msg["session"]
+
+        status, changes, msg = yield datastore.defer(datastore.updateAccount, "ALICE", {"nickname": "BOBBY"})
+        self.assertEqual((status, msg), (False, "nickname already in use"))
+
+        status, changes, msg = yield datastore.defer(datastore.updateAccount, "ALICE", {"nickname": "ALI", "squad": "abcd", "skin": 3})
+        self.assertTrue(status)
+        self.assertEqual(changes, {"nickname": "ALI", "squad": "abc", "skin": 3})
+
+        # the cached account from the login must not be served any more
+        status, msg, priv = yield datastore.defer(datastore.resumeSession, token)
+        self.assertEqual((msg["nickname"], msg["squad"], msg["skin"]), ("ALI", "abc", 3))
+
+    @defer.inlineCallbacks
+    def test_ban_is_seen_by_the_next_login(self):
+        status, msg, priv = yield datastore.register("ALICE", PASSWORD)
+        yield datastore.login("ALICE", PASSWORD)
+        yield datastore.defer(datastore.banAccount, priv["id"])
+        status, msg, priv = yield datastore.login("ALICE", PASSWORD)
+        self.assertTrue(priv["isBanned"])
+
+    @defer.inlineCallbacks
+    def test_change_password(self):
+        yield datastore.register("ALICE", PASSWORD)
+        yield datastore.login("ALICE", PASSWORD)
+        result = yield datastore.changePassword("ALICE", "newpassword1")
+        self.assertEqual(result, (True, ""))
+        status, msg, priv = yield datastore.login("ALICE", PASSWORD)
+        self.assertFalse(status)
+        status, msg, priv = yield datastore.login("ALICE", "newpassword1")
+        self.assertTrue(status)
+
+    @defer.inlineCallbacks
+    def test_busy_hash_pool(self):
+        # a full hash queue turns every kind of request away with the same reply
+        self.patch(datastore, "hashPool", object())
+        self.patch(datastore, "maxHashQueue", 0)
+        self.assertEqual((yield datastore.login("ALICE", PASSWORD)), (False, datastore.BUSY_MSG, None))
+        self.assertEqual((yield datastore.register("ALICE", PASSWORD)), (False, datastore.BUSY_MSG, None))
+        self.assertEqual((yield datastore.changePassword("ALICE", PASSWORD)), (False, datastore.BUSY_MSG))
+        self.assertEqual((yield datastore.changePassword("ALICE", "short")), (False, "password too short"))
+
+    @defer.inlineCallbacks
+    def test_sweep_drops_expired_sessions(self):
+        yield datastore.register("ALICE", PASSWORD)
+        datastore.openSessions(":memory:", -1)
+        yield datastore.login("ALICE", PASSWORD)
+        self.assertEqual(len(datastore.sessions), 1)
+        yield datastore.sweepSessions()
+        self.assertEqual(len(datastore.sessions), 0)
+        self.assertEqual(datastore.sessions.db.execute("SELECT COUNT(*) FROM sessions").fetchone(), (0,))
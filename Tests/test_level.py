@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from level import parseLevel, LOAD_MSG_CACHE_SIZE
+
+def makeLevel(layers):
+    zone = {"id": 0, "initial": 0, "color": "#000000", "music": "", "obj": [{"type": 97, "pos": 1, "param": []}], "warp": [], "layers": layers}
+    world = {"id": 0, "name": "0", "initial": 0, "zone": [zone]}
+    return json.dumps({"type": "game", "mode": "royale", "shortname": "test", "resource": [], "initial": 0, "world": [world]})
+
+MAIN = [[0, 1179648 | 5, 10485760], [1, 2, 3]]
+
+class ValidateLevelTest(unittest.TestCase):
+    def test_ragged_background_layer_loads(self):
+        level = parseLevel(makeLevel([{"z": -1, "data": [[0, 0, 0], [0]]}, {"z": 0, "data": MAIN}]))
+        self.assertEqual(level.zoneWidth, [[3]])
+        self.assertEqual(level.coinBlocks, [(0, 0, 1)])
+        self.assertTrue(level.isFlagpole(0, 0, 2))
+
+    def test_ragged_main_layer_is_rejected(self):
+        with self.assertRaisesRegex(Exception, "invalid level - rows"):
+            parseLevel(makeLevel([{"z": 0, "data": [[0, 0, 0], [0]]}]))
+
+    def test_tile_out_of_range_is_rejected(self):
+        with self.assertRaisesRegex(Exception, "invalid level - tile"):
+            parseLevel(makeLevel([{"z": 0, "data": [[0, 1 << 32]]}]))
+
+    def test_empty_or_missing_main_layer_is_rejected(self):
+        for layers in ([{"z": 0, "data": []}], [{"z": 0, "data": [[]]}], [{"z": 1, "data": MAIN}]):
+            with self.assertRaisesRegex(Exception, "minItems|invalid level"):
+                parseLevel(makeLevel(layers))
+
+    def test_round_trip(self):
+        level = parseLevel(makeLevel([{"z": -1, "data": [[7]]}, {"z": 0, "data": MAIN}]))
+        layers = level.toJSON({(0, 0, 3): 99})["world"][0]["zone"][0]["layers"]
+        self.assertEqual(layers[0]["data"], [[7]])
+        self.assertEqual(layers[1]["data"], [MAIN[0], [99, 2, 3]])
+
+class LoadMsgTest(unittest.TestCase):
+    def test_load_messages_are_cached_and_bounded(self):
+        level = parseLevel(makeLevel([{"z": 0, "data": MAIN}]))
+        calls = []
+        def encode(variant):
+            calls.append(variant)
+            return str(variant).encode()
+        for variant in range(LOAD_MSG_CACHE_SIZE + 1):
+            self.assertEqual(level.getLoadMsg(variant, lambda: encode(variant)), str(variant).encode())
+        self.assertEqual(len(level.loadMsgs), LOAD_MSG_CACHE_SIZE)
+        level.getLoadMsg(LOAD_MSG_CACHE_SIZE, lambda: encode("again"))
+        level.getLoadMsg(0, lambda: encode(0))
+        self.assertEqual(calls, list(range(LOAD_MSG_CACHE_SIZE + 1)) + [0])
+
+if __name__ == '__main__':
+    unittest.main()
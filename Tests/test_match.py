@@ -0,0 +1,112 @@
+import json
+import unittest
+
+from benchutil import FakeFactory, makeMatch
+
+class FakePlayer:
+    def __init__(self, id, posX, zone=0, win=False):
+        self.id = id
+        self.level = 0
+        self.zone = zone
+        self.posX = posX
+        self.posY = 5
+        self.loaded = True
+        self.win = win
+        self.zoneKey = None
+        self.gridCell = None
+        self.updateCount = 0
+        self.received = []
+
+    def sendBin(self, code, data):
+        self.received.append(code)
+
+def makeBroadMatch(players, interestRadius):
+    match = makeMatch(FakeFactory(interestRadius=interestRadius), zoneWidth=[[400, 100]], zoneHeight=[[15, 15]])
+    match.players = players
+    for p in players:
+        match.indexPlayer(p)
+    return match
+
+class BroadPlayerUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.sender = FakePlayer(0, 10)
+        self.near = FakePlayer(1, 12)
+        self.far = FakePlayer(2, 300)
+        self.podiumFar = FakePlayer(3, 390, win=True)
+        self.podiumOtherZone = FakePlayer(4, 10, zone=1, win=True)
+        self.otherZone = FakePlayer(5, 10, zone=1)
+        self.players = [self.sender, self.near, self.far, self.podiumFar, self.podiumOtherZone, self.otherZone]
+
+    def receivers(self):
+        return [p for p in self.players if p.received]
+
+    def test_zone_without_culling(self):
+        match = makeBroadMatch(self.players, 0)
+        match.broadPlayerUpdate(self.sender, b"")
+        self.assertEqual(self.receivers(), [self.near, self.far, self.podiumFar, self.podiumOtherZone])
+
+    def test_culling_keeps_podium_players(self):
+        match = makeBroadMatch(self.players, 16)
+        match.broadPlayerUpdate(self.sender, b"")
+        self.assertEqual(self.receivers(), [self.near, self.podiumFar, self.podiumOtherZone])
+        self.assertEqual(self.podiumFar.received, [0x12])
+
+    def test_podium_player_nearby_gets_one_update(self):
+        self.near.win = True
+        match = makeBroadMatch(self.players, 16)
+        match.broadPlayerUpdate(self.sender, b"")
+        self.assertEqual(self.near.received, [0x12])
+
+class ListPlayer:
+    def __init__(self, name):
+        self.name = name
+        self.isDev = False
+        self.loaded = True
+        self.playerListVersion = None
+        self.lists = []
+
+    def getSimpleData(self, isDev):
+        return {"id": self.id, "name": self.name}
+
+    def sendText(self, t):
+        self.lists.append(json.loads(t)["packets"][0])
+
+class BroadPlayerListTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeFactory()
+        self.match = makeMatch(self.server, playing=False)
+        self.first = self.join("A")
+
+    def join(self, name):
+        player = ListPlayer(name)
+        player.id = self.match.addPlayer(player)
+        return player
+
+    def test_deltas_turned_on_mid_match_start_with_a_snapshot(self):
+        self.match.broadPlayerList()
+        self.join("B")
+        self.server.playerListDeltas = True
+        self.join("C")
+        self.match.broadPlayerList()
+        last = self.first.lists[-1]
+        self.assertEqual(last["type"], "g12")
+        self.assertEqual([x["name"] for x in last["players"]], ["A", "B", "C"])
+        self.join("D")
+        self.match.broadPlayerList()
+        last = self.first.lists[-1]
+        self.assertEqual(last["type"], "g14")
+        self.assertEqual(last["base"], self.first.playerListVersion - 1)
+        self.assertEqual([x["name"] for x in last["add"]], ["D"])
+
+    def test_deltas_turned_off_send_snapshots(self):
+        self.server.playerListDeltas = True
+        self.match.playerListDeltas = True
+        self.match.broadPlayerList()
+        self.server.playerListDeltas = False
+        self.join("B")
+        self.match.broadPlayerList()
+        self.assertEqual([x["type"] for x in self.first.lists], ["g12", "g12"])
+        self.assertNotIn("version", self.first.lists[-1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from matchdirectory import MatchDirectory
+
+class FakeServer:
+    def __init__(self):
+        self.playerCap = 2
+        self.allowLateEnter = False
+
+class FakeMatch:
+    def __init__(self, gameMode=0, private=False, roomName=""):
+        self.gameMode = gameMode
+        self.private = private
+        self.roomName = roomName
+        self.closed = False
+        self.playing = False
+        self.players = []
+
+class MatchDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.directory = MatchDirectory(self.server)
+
+    def add(self, *args):
+        match = FakeMatch(*args)
+        self.directory.add(match)
+        return match
+
+    def test_oldest_joinable_match_first(self):
+        a, b, c = self.add(), self.add(), self.add()
+        self.assertIs(self.directory.find("", False, 0), a)
+        a.players = [1, 2]
+        self.assertIs(self.directory.find("", False, 0), b)
+        b.closed = True
+        self.assertIs(self.directory.find("", False, 0), c)
+        # a player left a, so it is the oldest joinable match again
+        a.players = [1]
+        self.directory.update(a)
+        self.assertIs(self.directory.find("", False, 0), a)
+
+    def test_keys(self):
+        public = self.add(0, False, "ignored")
+        private = self.add(0, True, "room")
+        other = self.add(1)
+        self.assertIs(self.directory.find("", False, 0), public)
+        self.assertIs(self.directory.find("anything", False, 0), public)
+        self.assertIs(self.directory.find("room", True, 0), private)
+        self.assertIsNone(self.directory.find("other", True, 0))
+        self.assertIs(self.directory.find("", False, 1), other)
+        self.assertIsNone(self.directory.find("", False, 2))
+
+    def test_playing_and_late_enter(self):
+        a = self.add()
+        a.playing = True
+        self.assertIsNone(self.directory.find("", False, 0))
+        self.server.allowLateEnter = True
+        self.directory.refresh()
+        self.assertIs(self.directory.find("", False, 0), a)
+
+    def test_player_cap_refresh(self):
+        a, b = self.add(), self.add()
+        a.players = b.players = [1, 2]
+        self.assertIsNone(self.directory.find("", False, 0))
+        self.server.playerCap = 3
+        self.directory.refresh()
+        self.assertIs(self.directory.find("", False, 0), a)
+
+    def test_remove(self):
+        a, b = self.add(), self.add()
+        self.directory.remove(a)
+        self.directory.remove(a)
+        self.assertNotIn(a, self.directory)
+        self.assertEqual(len(self.directory), 1)
+        self.assertIs(self.directory.find("", False, 0), b)
+        self.directory.remove(b)
+        self.assertIsNone(self.directory.find("", False, 0))
+        self.assertEqual(self.directory.heaps, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import struct
+import unittest
+
+from benchutil import FakeFactory, FakePlayer, importServer
+
+server = importServer()
+
+class Protocol(server.MyServerProtocol):
+    def __init__(self, factory):
+        server.MyServerProtocol.__init__(self, factory)
+        self.player = FakePlayer()
+        self.closed = False
+
+    def sendClose2(self):
+        self.closed = True
+
+# level, zone, pos, sprite, reverse
+frame = bytes([0x12, 0, 1]) + struct.pack("!ff", 35.5, 3.25) + bytes([2, 0])
+fields = (0, 1, 35.5, 3.25, 2, 0)
+
+class BinaryMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = Protocol(FakeFactory())
+
+    def test_coalesced_message(self):
+        self.protocol.onMessage(frame * 100, True)
+        self.assertFalse(self.protocol.closed)
+        self.assertEqual(self.protocol.player.packets, [(0x12, fields)] * 100)
+        self.assertEqual(len(self.protocol.recv), 0)
+
+    def test_frame_split_across_messages(self):
+        payload = frame * 10
+        self.protocol.onMessage(payload[:20], True)
+        self.assertEqual(len(self.protocol.player.packets), 1)
+        self.assertEqual(bytes(self.protocol.recv), payload[13:20])
+        self.protocol.onMessage(payload[20:], True)
+        self.assertEqual(self.protocol.player.packets, [(0x12, fields)] * 10)
+        self.assertEqual(len(self.protocol.recv), 0)
+        self.assertFalse(self.protocol.closed)
+
+    def test_unknown_opcode_drops_the_rest(self):
+        self.protocol.onMessage(frame + bytes([0xFF]) + frame, True)
+        self.assertEqual(self.protocol.player.packets, [(0x12, fields)])
+        self.assertEqual(len(self.protocol.recv), 0)
+        self.assertFalse(self.protocol.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import itertools
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from twisted.internet import defer, task
+from twisted.trial import unittest
+import datastore
+from statsbuffer import StatsBuffer, mergeStats
+
+def addAccounts(session, count):
+    for i in range(1, count + 1):
+        session.add(datastore.Account(id=i, username="USER%d" % i, salt="", pwdhash="", nickname="USER%d" % i, skin=0, squad=""))
+    session.commit()
+
+def writeRow(session, accId, fields, rowId):
+    datastore.applyStats(session, {accId: fields})
+    session.add(datastore.StatsBatch(id=rowId, created=0))
+    session.commit()
+
+def getStats(session):
+    return {x.id: (x.wins, x.kills, x.coins) for x in session.query(datastore.Account)}
+
+def countBatches(session):
+    return session.query(datastore.StatsBatch).count()
+
+class MergeStatsTest(unittest.TestCase):
+    def test_coins_merge_like_clamping_each_change(self):
+        for deltas in itertools.product([-7, -2, 0, 3, 10], repeat=3):
+            merged = {}
+            for d in deltas:
+                mergeStats(merged, {"coins": d})
+            for start in (0, 1, 5, 20):
+                coins = start
+                for d in deltas:
+                    coins = max(0, coins + d)
+                self.assertEqual(max(merged["coinsFloor"], start + merged["coins"]), coins)
+
+    def test_counters_add_and_other_fields_overwrite(self):
+        merged = mergeStats({}, {"wins": 1, "nickname": "A", "squad": "x"})
+        mergeStats(merged, {"wins": 2, "kills": 1, "nickname": "B", "squad": "y"})
+        self.assertEqual(merged, {"wins": 3, "kills": 1, "nickname": "B", "squad": "y"})
+
+class StatsBufferTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        datastore.openDb("sqlite:///:memory:")
+        datastore.accountCache = datastore.AccountCache(100, 60)
+        datastore.startPool(2)
+        self.addCleanup(datastore.stopPool)
+        journalDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journalDir)
+        self.journalPath = os.path.join(journalDir, "stats.journal")
+        self.clock = task.Clock()
+        yield datastore.defer(addAccounts, 2)
+
+    def makeBuffer(self):
+        stats = StatsBuffer(self.journalPath, 10, 100, self.clock)
+        self.addCleanup(stats.stop)
+        return stats
+
+    @defer.inlineCallbacks
+    def test_flush_writes_batch_and_removes_journal(self):
+        stats = self.makeBuffer()
+        stats.add(1, {"wins": 1, "coins": 5})
+        stats.add(1, {"kills": 2, "coins": -20})
+        stats.add(2, {"coins": 3})
+        yield stats.flush()
+        self.assertEqual((yield datastore.defer(getStats)), {1: (1, 2, 0), 2: (0, 0, 3)})
+        self.assertFalse(os.path.exists(self.journalPath))
+        self.assertEqual(stats.batches, [])
+        self.assertEqual((yield datastore.defer(countBatches)), 0)
+
+    @defer.inlineCallbacks
+    def test_replayed_batch_is_not_added_twice(self):
+        # the batch was committed but the server died before the journal was updated
+        with open(self.journalPath, "w") as f:
+            f.write(json.dumps([{"batch": "abc", "rows": [[1, {"wins": 1, "coins": 4, "coinsFloor": 0}]]}]))
+        yield datastore.defer(datastore.flushStats, {1: {"wins": 1, "coins": 4, "coinsFloor": 0}}, "abc")
+        stats = self.makeBuffer()
+        self.assertEqual(stats.batches, [["abc", {1: {"wins": 1, "coins": 4, "coinsFloor": 0}}]])
+        stats.add(2, {"wins": 1})
+        yield stats.stop()
+        self.assertEqual((yield datastore.defer(getStats)), {1: (1, 0, 4), 2: (1, 0, 0)})
+        self.assertFalse(os.path.exists(self.journalPath))
+
+    @defer.inlineCallbacks
+    def test_rows_written_one_by_one_are_skipped_on_replay(self):
+        yield datastore.defer(writeRow, 1, {"kills": 3}, "abc:1")
+        failed, totals = yield datastore.defer(datastore.flushStats, {1: {"kills": 3}, 2: {"kills": 1}}, "abc")
+        self.assertEqual(failed, {})
+        self.assertEqual(set(totals), {1, 2})
+        self.assertEqual((yield datastore.defer(getStats)), {1: (0, 3, 0), 2: (0, 1, 0)})
+
+    @defer.inlineCallbacks
+    def test_close_journals_pending_and_unwritten_batches(self):
+        stats = self.makeBuffer()
+        stats.batches.append(["abc", {1: {"wins": 1}}])
+        stats.add(2, {"coins": -1})
+        stats.close()
+        stats = self.makeBuffer()
+        self.assertEqual(stats.batches, [["abc", {1: {"wins": 1}}]])
+        self.assertEqual(stats.pending, {2: {"coins": -1, "coinsFloor": 0}})
+        yield stats.stop()
+        self.assertEqual((yield datastore.defer(getStats)), {1: (1, 0, 0), 2: (0, 0, 0)})
+        self.assertFalse(os.path.exists(self.journalPath))
@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from twisted.internet import task
+import util
+
+class ExpiringSetTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.set = util.ExpiringSet(3, clock=self.clock)
+        self.addCleanup(self.set.stop)
+
+    def test_members_expire_after_ttl(self):
+        self.set.add("a")
+        self.clock.advance(1)
+        self.set.add("b")
+        self.assertEqual(len(self.set), 2)
+        self.clock.advance(2)
+        self.assertNotIn("a", self.set)
+        self.assertIn("b", self.set)
+        self.clock.advance(1)
+        self.assertNotIn("b", self.set)
+        self.assertEqual(len(self.set), 0)
+
+    def test_add_again_restarts_ttl(self):
+        self.set.add("a")
+        self.clock.advance(2)
+        self.set.add("a")
+        self.clock.advance(2)
+        self.assertIn("a", self.set)
+        self.clock.advance(1)
+        self.assertNotIn("a", self.set)
+
+    def test_stalled_reactor_counts_missed_ticks(self):
+        self.set.add("a")
+        self.clock.advance(10)
+        self.assertNotIn("a", self.set)
+        self.set.add("b")
+        self.clock.advance(2)
+        self.assertIn("b", self.set)
+        self.clock.advance(1)
+        self.assertNotIn("b", self.set)
+
+    def test_discard(self):
+        self.set.add("a")
+        self.set.discard("a")
+        self.set.discard("missing")
+        self.assertNotIn("a", self.set)
+        self.clock.advance(3)
+        self.assertEqual(len(self.set), 0)
+
+    def test_resolution(self):
+        s = util.ExpiringSet(10, resolution=5, clock=self.clock)
+        self.addCleanup(s.stop)
+        s.add("a")
+        self.clock.advance(5)
+        self.assertIn("a", s)
+        self.clock.advance(5)
+        self.assertNotIn("a", s)
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = util.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+
+    def test_put_existing_key_refreshes_it(self):
+        cache = util.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("a", 10)
+        cache.put("c", 3)
+        self.assertEqual(cache.get("a"), 10)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+
+    def test_pop(self):
+        cache = util.LRUCache(2)
+        cache.put("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+'''
+Memory report for the per-match level state: the old deepcopy with nested list tiles
+versus Match.instantiateLevel on a shared Level, where a match only keeps the tiles it
+changed. Pass a level file to measure it, otherwise a synthetic royale sized level is
+used.
+
+usage: python tile_memory_report.py [level.json]
+'''
+
+import sys
+import copy
+import json
+import random
+import tracemalloc
+
+from benchutil import FakeFactory, makeMatch
+from level import Level
+
+MATCHES = 20
+
+def syntheticLevel():
+    rng = random.Random(1)
+    def zone(id, width):
+        data = [[rng.choice([0, 98306, 98331, 1179648 | 98306, 10485760]) for x in range(width)] for y in range(15)]
+        return {"id": id, "initial": 0, "color": "#000000", "music": "", "obj": [], "warp": [], "data": data}
+    worlds = [{"id": w, "name": str(w), "initial": 0, "zone": [zone(z, 400 if z == 0 else 80) for z in range(3)]} for w in range(5)]
+    level = {"type": "game", "mode": "royale", "shortname": "test", "resource": [], "initial": 0, "world": worlds}
+    return json.loads(json.dumps(level))    # as if it came from a file, one int object per tile
+
+# every match deep-copied the level json, tiles and all
+def oldInstantiate(levelData):
+    level = copy.deepcopy(levelData)
+    def fixLayersZ(x):
+        if "data" in x:
+            x["layers"]=[{"z":0, "data":x["data"]}]
+            del x["data"]
+    for w in level["world"]:
+        for z in w["zone"]:
+            fixLayersZ(z)
+    return level
+
+def newInstantiate(level):
+    match = makeMatch(FakeFactory(), customLevelData=level, usingCustomLevel=False)
+    match.instantiateLevel()
+    return match
+
+def measure(name, func, levelData):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [func(levelData) for i in range(MATCHES)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    perMatch = (after - before) / MATCHES
+    print("{0:<14} {1:12.0f} bytes per match".format(name, perMatch))
+    return perMatch
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8-sig") as f:
+            levelData = json.loads(f.read())
+    else:
+        levelData = syntheticLevel()
+    tileCount = 0
+    for w in levelData["world"]:
+        for z in w["zone"]:
+            data = z["data"] if "data" in z else [l for l in z["layers"] if l["z"] == 0][0]["data"]
+            tileCount += sum(len(row) for row in data)
+    print("{0} main layer tiles, {1} matches".format(tileCount, MATCHES))
+
+    old = measure("nested lists", oldInstantiate, levelData)
+    new = measure("shared Level", newInstantiate, Level(copy.deepcopy(levelData)))
+    print("{0:.2f} -> {1:.2f} bytes per tile".format(old / tileCount, new / tileCount))
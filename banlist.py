@@ -0,0 +1,48 @@
+import ipaddress
+
+class BanList(object):
+    # The [address, name, reason] entries of blocked.json. Plain addresses are kept in a
+    # set and CIDR ranges such as "10.1.0.0/16" in one set per (ip version, prefix length),
+    # so a lookup costs one probe per prefix length in use instead of a scan of every ban.
+    def __init__(self, entries=None):
+        self.entries = []
+        self.addresses = set()
+        self.networks = {}  # (version, prefixlen) -> {network address >> host bits}
+        for entry in entries or []:
+            self.add(entry)
+
+    def add(self, entry):
+        self.entries.append(entry)
+        address = entry[0]
+        if "/" in address:
+            try:
+                network = ipaddress.ip_network(address, strict=False)
+            except ValueError:
+                pass
+            else:
+                shift = network.max_prefixlen - network.prefixlen
+                key = (network.version, network.prefixlen)
+                self.networks.setdefault(key, set()).add(int(network.network_address) >> shift)
+                return
+        self.addresses.add(address)
+
+    def __contains__(self, address):
+        if address in self.addresses:
+            return True
+        if not self.networks:
+            return False
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        value = int(ip)
+        for (version, prefixlen), prefixes in self.networks.items():
+            if version == ip.version and value >> (ip.max_prefixlen - prefixlen) in prefixes:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def toList(self):
+        return self.entries
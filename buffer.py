@@ -1,16 +1,36 @@
 import struct
 
+INT16 = struct.Struct("!H")
+INT24 = struct.Struct("!BH")
+INT32 = struct.Struct("!I")
+FLOAT = struct.Struct("!f")
+SHOR2 = struct.Struct("!hh")
+VEC2 = struct.Struct("!ff")
+
 class Buffer:
-    def __init__(self, data=None):
+    # Reads advance a cursor instead of shifting the underlying bytes, so a Buffer can
+    # also be laid over a memoryview (or any slice of a bigger receive buffer) with
+    # offset/end and nothing gets copied until read() or toBytes() is called.
+    def __init__(self, data=None, offset=0, end=None):
         self.buffer = data if data is not None else bytearray()
+        self.pos = offset
+        self.end = end if end is not None else len(self.buffer)
     
     def write(self, data):
         self.buffer += data
+        self.end = len(self.buffer)
         return self
     
+    def skip(self, length):
+        if self.pos + length > self.end:
+            raise IndexError("read past end of buffer")
+        self.pos += length
+        return self.pos - length
+
     def read(self, length=1):
-        data = self.buffer[:length]
-        del self.buffer[:length]
+        length = min(length, self.end - self.pos)
+        data = bytes(self.buffer[self.pos:self.pos + length])
+        self.pos += length
         return data
     
     def writeInt8(self, data):
@@ -18,58 +38,78 @@ class Buffer:
         return self
     
     def readInt8(self):
-        return self.buffer.pop(0)
+        pos = self.pos
+        if pos >= self.end:
+            raise IndexError("read past end of buffer")
+        self.pos = pos + 1
+        return self.buffer[pos]
     
     def writeInt16(self, data):
         self.write(bytes([(data >> 8) & 0xFF, (data >> 0) & 0xFF]))
         return self
     
     def readInt16(self):
-        return self.readInt8() << 8 | self.readInt8() << 0
+        pos = self.pos
+        if pos + 2 > self.end:
+            raise IndexError("read past end of buffer")
+        self.pos = pos + 2
+        return INT16.unpack_from(self.buffer, pos)[0]
     
     def writeInt24(self, data):
         self.write(bytes([(data >> 16) & 0xFF, (data >> 8) & 0xFF, (data >> 0) & 0xFF]))
         return self
     
     def readInt24(self):
-        return self.readInt8() << 16 | self.readInt8() << 8 | self.readInt8() << 0
+        hi, lo = INT24.unpack_from(self.buffer, self.skip(3))
+        return hi << 16 | lo
     
     def writeInt32(self, data):
         self.write(bytes([(data >> 24) & 0xFF, (data >> 16) & 0xFF, (data >> 8) & 0xFF, (data >> 0) & 0xFF]))
         return self
     
     def readInt32(self):
-        return self.readInt8() << 24 | self.readInt8() << 16 | self.readInt8() << 8 | self.readInt8() << 0
+        pos = self.pos
+        if pos + 4 > self.end:
+            raise IndexError("read past end of buffer")
+        self.pos = pos + 4
+        return INT32.unpack_from(self.buffer, pos)[0]
 
     def writeBool(self, data):
         self.write(bytes([1 if data else 0]))
         return self
     
     def readBool(self):
-        return self.buffer.pop(0) == 1
+        return self.readInt8() == 1
     
     def readFloat(self):
-        data = struct.unpack("!f", self.read(4))[0]
-        return data
+        pos = self.pos
+        if pos + 4 > self.end:
+            raise IndexError("read past end of buffer")
+        self.pos = pos + 4
+        return FLOAT.unpack_from(self.buffer, pos)[0]
 
     def writeFloat(self, data):
-        self.write(struct.pack("!f", data))
+        self.write(FLOAT.pack(data))
         return self
 
     def readShor2(self):
-        data = struct.unpack("<hh", self.read(4)[::-1])
-        return data
+        # shor2 is sent as two big-endian shorts in (y, x) order
+        y, x = SHOR2.unpack_from(self.buffer, self.skip(4))
+        return (x, y)
 
     def writeShor2(self, _1, _2):
-        self.write(struct.pack("<hh", int(_1), int(_2))[::-1])
+        self.write(SHOR2.pack(int(_2), int(_1)))
         return self
 
     def readVec2(self):
-        data = struct.unpack("!ff", self.read(8))
-        return data
+        pos = self.pos
+        if pos + 8 > self.end:
+            raise IndexError("read past end of buffer")
+        self.pos = pos + 8
+        return VEC2.unpack_from(self.buffer, pos)
 
     def writeVec2(self, _1, _2):
-        self.write(struct.pack("!ff", _1, _2))
+        self.write(VEC2.pack(_1, _2))
         return self
     
     def writeString(self, data):
@@ -81,11 +121,11 @@ class Buffer:
         return self.read(self.readInt16())
     
     def writeBuffer(self, buffer):
-        self.buffer += buffer
+        self.write(buffer)
         return self
 
     def length(self):
-        return len(self.buffer)
+        return self.end - self.pos
     
     def getLength(self):
         return self.length()
@@ -94,10 +134,14 @@ class Buffer:
         return self.length() > 0
 
     def toString(self):
-        return self.buffer.decode('utf-8')
+        return self.toBytes().decode('utf-8')
     
     def toBytes(self):
-        return bytes(self.buffer)
+        if self.pos == 0 and self.end == len(self.buffer):
+            return bytes(self.buffer)
+        return bytes(memoryview(self.buffer)[self.pos:self.end])
     
     def clear(self):
-        self.buffer = ""
+        self.buffer = bytearray()
+        self.pos = 0
+        self.end = 0
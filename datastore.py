@@ -3,6 +3,7 @@ import hashlib
 import traceback
 import re
 import util
+from sessionstore import SessionStore
 import json
 
 try:
@@ -14,19 +15,39 @@ except:
     A2_IMPORT = False
 
 import pickle
-import secrets
+import concurrent.futures
+import threading
+import time
+from twisted.internet import threads
+from twisted.internet.defer import Deferred, succeed, maybeDeferred
+from twisted.python.threadpool import ThreadPool
 
-loggedInSessions = {}
+BUSY_MSG = "server busy, please retry"
+
+def newPoolStats():
+    return {"checkouts": 0, "wait": 0.0, "maxWait": 0.0, "peak": 0, "timeouts": 0}
+
+sessions = None
+pool = None
+hashPool = None
+hashFutures = set()    # submitted to hashPool and not done yet
+poolCapacity = None
+poolStats = newPoolStats()
+poolStatsLock = threading.Lock()
+hashQueue = 0       # register/login/changePassword calls admitted and not finished yet
+maxHashQueue = 0
 
 if A2_IMPORT:
     ph = argon2.PasswordHasher()
 else:
     ph = None
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, create_engine
+from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, create_engine, bindparam, case
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.schema import MetaData
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.exc import IntegrityError, DataError, TimeoutError as SQLTimeoutError
 
 Base = declarative_base()
 
@@ -40,10 +61,10 @@ class Account(Base):
     skin = Column(Integer, nullable=False)
     squad = Column(String(10), nullable=False)
     isDev = Column(Boolean, nullable=False, default=False)
-    wins = Column(Integer, nullable=False, default=0, server_default="0")
+    wins = Column(Integer, nullable=False, default=0, server_default="0", index=True)
     deaths = Column(Integer, nullable=False, default=0, server_default="0")
-    kills = Column(Integer, nullable=False, default=0, server_default="0")
-    coins = Column(Integer, nullable=False, default=0, server_default="0")
+    kills = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+    coins = Column(Integer, nullable=False, default=0, server_default="0", index=True)
     isBanned = Column(Boolean, nullable=False, default=False, server_default="0")
     def summary(self):
         return {"username":self.username, "nickname":self.nickname, "skin":self.skin, "squad":self.squad, "isDev":self.isDev,
@@ -51,6 +72,13 @@ class Account(Base):
     def privSummary(self):
         return {"id":self.id, "isBanned":self.isBanned}
 
+class StatsBatch(Base):
+    # Stats batches (id) and rows of a batch written one by one (id:account id) already in
+    # the database, so a batch replayed from the journal after a crash isn't added twice
+    __tablename__ = "stats_batches"
+    id = Column(String(64), primary_key=True)
+    created = Column(Integer, nullable=False)
+
 def checkTableSchema(expected, actual):
     for col in expected.c.keys():
         if not col in actual.c:
@@ -64,17 +92,37 @@ def checkTableSchema(expected, actual):
             print(sql)
             engine.execute(sql)
 
+def checkTableIndexes(expected, actual):
+    existing = set(x.name for x in actual.indexes)
+    for index in expected.indexes:
+        if not index.name in existing:
+            print("missing index from db: "+index.name)
+            index.create(engine)
+
 def checkTableSchemas(existingMetaData):
     for t in Base.metadata.tables.keys():
         if t in existingMetaData.tables:
             checkTableSchema(Base.metadata.tables[t], existingMetaData.tables[t])
+            checkTableIndexes(Base.metadata.tables[t], existingMetaData.tables[t])
         else:
             Base.metadata.tables[t].create()
 
-def checkDb(host, port, user, password, db):
+def checkDb(host, port, user, password, db, poolSize=8, maxOverflow=4, poolTimeout=10):
+    openDb("mysql+mysqlconnector://"+user+":"+password+"@"+host+":"+str(port)+"/"+db, poolSize, maxOverflow, poolTimeout)
+
+def openDb(url, poolSize=8, maxOverflow=4, poolTimeout=10):
+    # any SQLAlchemy url works, e.g. sqlite:///accounts.db for a local test database
     global engine
     global DBSession
-    engine = create_engine("mysql+mysqlconnector://"+user+":"+password+"@"+host+":"+str(port)+"/"+db, echo=False, pool_size=10000, pool_recycle=3600)
+    global poolCapacity
+    if url.startswith("sqlite"):
+        # an in-memory database exists once per connection, so every thread has to share one
+        poolclass = StaticPool if url in ("sqlite://", "sqlite:///:memory:") else None
+        engine = create_engine(url, echo=False, connect_args={"check_same_thread": False}, poolclass=poolclass)
+        poolCapacity = None
+    else:
+        engine = create_engine(url, echo=False, pool_size=poolSize, max_overflow=maxOverflow, pool_timeout=poolTimeout, pool_recycle=3600)
+        poolCapacity = poolSize + maxOverflow
     Base.metadata.bind = engine
     Base.metadata.reflect()
     DBSession = sessionmaker(bind=engine)
@@ -84,8 +132,136 @@ def checkDb(host, port, user, password, db):
     checkTableSchemas(existingMetaData)
     session.close()
 
-def getDbSession():
-    return DBSession()
+def startPool(threadCount):
+    # Database calls run on their own bounded pool, so slow queries can't starve the
+    # reactor's default thread pool (used for level loading)
+    global pool
+    from twisted.internet import reactor
+    pool = ThreadPool(minthreads=1, maxthreads=threadCount, name="datastore")
+    pool.start()
+    reactor.addSystemEventTrigger("during", "shutdown", stopPool)
+
+def stopPool():
+    global pool
+    if pool is not None:
+        pool.stop()
+        pool = None
+
+def defer(func, *args):
+    # Runs func(session, *args) in the pool with a session of its own and returns a
+    # Deferred that fires with the result on the reactor thread.
+    from twisted.internet import reactor
+    def run():
+        session = DBSession()
+        try:
+            checkout(session)
+            return func(session, *args)
+        finally:
+            session.close()
+    return threads.deferToThreadPool(reactor, pool, run)
+
+def deferCall(func, *args):
+    # Runs func(*args) in the pool without a database session, for the session store
+    from twisted.internet import reactor
+    return threads.deferToThreadPool(reactor, pool, func, *args)
+
+def checkout(session):
+    # Takes the session's connection from the engine pool up front, to measure the wait
+    start = time.perf_counter()
+    try:
+        session.connection()
+    except SQLTimeoutError:
+        with poolStatsLock:
+            poolStats["timeouts"] += 1
+        raise
+    wait = time.perf_counter() - start
+    inUse = engine.pool.checkedout() if poolCapacity is not None else 0
+    with poolStatsLock:
+        poolStats["checkouts"] += 1
+        poolStats["wait"] += wait
+        poolStats["maxWait"] = max(poolStats["maxWait"], wait)
+        poolStats["peak"] = max(poolStats["peak"], inUse)
+
+def takePoolStats():
+    # Returns the pool metrics gathered since the last call and starts over
+    global poolStats
+    with poolStatsLock:
+        stats = poolStats
+        poolStats = newPoolStats()
+    stats["capacity"] = poolCapacity
+    return stats
+
+# argon2 is CPU bound, so it runs in worker processes instead of the reactor or the
+# datastore threads. register/login/changePassword are admitted only while fewer than
+# maxHashQueue of them are in progress, the rest get BUSY_MSG straight away.
+def hashPassword(password, salt):
+    return ph.hash(password.encode('utf-8')+salt.encode('ascii'))
+
+def verifyPassword(pwdhash, password, salt):
+    try:
+        return ph.verify(pwdhash, password.encode('utf-8')+salt.encode('ascii'))
+    except argon2.exceptions.VerifyMismatchError:
+        return False
+
+def startHashPool(workers, maxQueue):
+    global hashPool
+    global maxHashQueue
+    if ph is None:
+        return
+    from twisted.internet import reactor
+    maxHashQueue = maxQueue
+    workers = workers or os.cpu_count()
+    hashPool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    # start every worker now, before the reactor has any threads running and before any
+    # database handles are open, so the forked processes don't inherit them. Since 3.9 a
+    # worker is only forked by a submit that finds none idle, so each warm-up task keeps
+    # its worker busy until all of them are submitted.
+    warmups = [hashPool.submit(time.sleep, 0.2) for i in range(workers)]
+    concurrent.futures.wait(warmups)
+    reactor.addSystemEventTrigger("during", "shutdown", stopHashPool)
+
+def stopHashPool():
+    global hashPool
+    if hashPool is not None:
+        # shutdown() only learned to cancel queued work in 3.9
+        for future in list(hashFutures):
+            future.cancel()
+        hashPool.shutdown(wait=False)
+        hashPool = None
+
+def admitHash():
+    global hashQueue
+    if hashPool is not None and hashQueue >= maxHashQueue:
+        return False
+    hashQueue += 1
+    return True
+
+def releaseHash(result):
+    global hashQueue
+    hashQueue -= 1
+    return result
+
+def runHash(func, *args):
+    # Runs func(*args) in the hash pool and returns a Deferred firing on the reactor thread.
+    # Without a pool it runs right here, blocking the caller.
+    from twisted.internet import reactor
+    if hashPool is None:
+        return maybeDeferred(func, *args)
+    d = Deferred()
+    def fire(future):
+        try:
+            result = future.result()
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+    def done(future):
+        hashFutures.discard(future)
+        reactor.callFromThread(fire, future)
+    future = hashPool.submit(func, *args)
+    hashFutures.add(future)
+    future.add_done_callback(done)
+    return d
 
 def persistState(session):
     try:
@@ -95,92 +271,174 @@ def persistState(session):
         session.rollback()
         return False
 
-def register(session, username, password):
+def openSessions(path, ttl):
+    global sessions
+    if sessions is not None:
+        sessions.close()
+    sessions = SessionStore(path, ttl)
+    print("{0} login sessions in {1}".format(len(sessions), path))
+
+def openSession(username, summary):
+    # Returns a Deferred, the session store writes its file in the pool
+    def created(token):
+        summary["session"] = token
+        return summary
+    return deferCall(sessions.create, username).addCallback(created)
+
+def sweepSessions():
+    return deferCall(sessions.sweep)
+
+class AccountCache(object):
+    # Read-through cache of (summary, privSummary, pwdhash, salt) by username, for logins
+    # and resumes, with the ids alongside so stats writes can drop their accounts too.
+    # Every write in this module invalidates; ttl bounds how stale an entry can get when
+    # another server writes to the same database. Used from the datastore threads.
+    def __init__(self, maxSize, ttl):
+        self.byName = util.LRUCache(maxSize)    # username -> (expires, record)
+        self.byId = util.LRUCache(maxSize)      # id -> username
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.generation = 0     # bumped by every invalidation, so a read racing a write isn't cached
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        with self.lock:
+            entry = self.byName.get(username)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.byId.get(entry[1][1]["id"])
+            return entry[1]
+
+    def put(self, acc, generation):
+        record = (acc.summary(), acc.privSummary(), acc.pwdhash, acc.salt)
+        with self.lock:
+            if generation == self.generation:
+                self.byName.put(acc.username, (time.time() + self.ttl, record))
+                self.byId.put(acc.id, acc.username)
+        return record
+
+    def invalidate(self, username=None, accId=None):
+        with self.lock:
+            self.generation += 1
+            if accId is not None:
+                username = self.byId.pop(accId, username)
+            if username is not None:
+                self.byName.pop(username)
+
+    def __len__(self):
+        return len(self.byName)
+
+accountCache = AccountCache(10000, 60)
+
+def loadAccount(session, username):
+    # Returns (summary, privSummary, pwdhash, salt) of the account or None. The dicts are
+    # shared with the cache, so callers copy them before changing anything.
+    record = accountCache.get(username)
+    if record is not None:
+        return record
+    generation = accountCache.generation
+    acc = session.query(Account).filter_by(username=username).first()
+    if acc is None:
+        return None
+    return accountCache.put(acc, generation)
+
+def accountExists(session, username):
+    if accountCache.get(username) is not None:
+        return True
+    return session.query(session.query(Account.id).filter_by(username=username).exists()).scalar()
+
+def createAccount(session, username, salt, pwdhash):
+    acc = Account(username=username, salt=salt, pwdhash=pwdhash, nickname=username,skin=0,squad="")
+    session.add(acc)
+    if not persistState(session):
+        return None
+    return acc.summary(), acc.privSummary()
+
+def register(username, password):
+    # Called on the reactor, returns a Deferred firing with (status, msg, priv). The
+    # queries run on the datastore pool and the hashing in the hash pool.
     if ph is None:
-        return False, "account system disabled", None
+        return succeed((False, "account system disabled", None))
     if len(username) < 3:
-        return False, "username too short", None
+        return succeed((False, "username too short", None))
     if len(username) > 20:
-        return False, "username too long", None
+        return succeed((False, "username too long", None))
     if not re.match('^[a-zA-Z0-9]+$', username):
-        return False, "illegal character in username", None
+        return succeed((False, "illegal character in username", None))
     if len(password) < 8:
-        return False, "password too short", None
+        return succeed((False, "password too short", None))
     if len(password) > 120:
-        return False, "password too long", None
-    if 0<session.query(Account).filter_by(username=username).count():
-        return False, "account already registered", None
+        return succeed((False, "password too long", None))
     if not allowedNickname(username):
-        return False, "nickname not allowed", None
-
-    salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
-    pwdhash = ph.hash(password.encode('utf-8')+salt)
-    
-    acc = Account(username=username, salt=salt, pwdhash=pwdhash, nickname=username,skin=0,squad="")
-    session.add(acc)
-    if not persistState(session):
-        return False, "failed to save account", None
+        return succeed((False, "nickname not allowed", None))
+    if not admitHash():
+        return succeed((False, BUSY_MSG, None))
 
-    acc2 = acc.summary()
-    
-    token = secrets.token_urlsafe(32)
-    loggedInSessions[token] = username
-    acc2["session"] = token
-    return True, acc2, acc.privSummary()
+    salt = hashlib.sha256(os.urandom(60)).hexdigest()
+    def created(acc):
+        if acc is None:
+            return False, "failed to save account", None
+        summary, priv = acc
+        return openSession(username, summary).addCallback(lambda summary: (True, summary, priv))
+    def checked(exists):
+        if exists:
+            return False, "account already registered", None
+        d = runHash(hashPassword, password, salt)
+        d.addCallback(lambda pwdhash: defer(createAccount, username, salt, pwdhash))
+        return d.addCallback(created)
+    return defer(accountExists, username).addCallback(checked).addBoth(releaseHash)
 
-def login(session, username, password):
+def login(username, password):
+    # Same as register, returns a Deferred
     if ph is None:
-        return False, "account system disabled", None
+        return succeed((False, "account system disabled", None))
     
     invalidMsg = "invalid user name or password"
     if len(username) < 3:
-        return False, invalidMsg, None
+        return succeed((False, invalidMsg, None))
     if len(username) > 20:
-        return False, invalidMsg, None
+        return succeed((False, invalidMsg, None))
     if len(password) < 8:
-        return False, invalidMsg, None
+        return succeed((False, invalidMsg, None))
     if len(password) > 120:
-        return False, invalidMsg, None
+        return succeed((False, invalidMsg, None))
+    if not admitHash():
+        return succeed((False, BUSY_MSG, None))
 
-    accs = session.query(Account).filter_by(username=username).all()
-    if 0==len(accs):
-        return False, invalidMsg, None
-    acc = accs[0]
-
-    try:
-        ph.verify(acc.pwdhash, password.encode('utf-8')+acc.salt.encode('ascii'))
-    except argon2.exceptions.VerifyMismatchError:
-        return False, invalidMsg, None
-    
-    acc2 = acc.summary()
-    
-    token = secrets.token_urlsafe(32)
-    loggedInSessions[token] = username
-    acc2["session"] = token
-    return True, acc2, acc.privSummary()
+    def found(acc):
+        if acc is None:
+            return False, invalidMsg, None
+        summary, priv, pwdhash, salt = acc
+        def verified(ok):
+            if not ok:
+                return False, invalidMsg, None
+            return openSession(username, dict(summary)).addCallback(lambda summary: (True, summary, dict(priv)))
+        return runHash(verifyPassword, pwdhash, password, salt).addCallback(verified)
+    return defer(loadAccount, username).addCallback(found).addBoth(releaseHash)
 
 def resumeSession(session, token):
-    if token not in loggedInSessions:
+    username = sessions.get(token)
+    if username is None:
         return False, "session expired, please log in", None
 
-    username = loggedInSessions[token]
-    accs = session.query(Account).filter_by(username=username).all()
-    if 0==len(accs):
+    acc = loadAccount(session, username)
+    if acc is None:
         return False, "invalid user name or password", None
-    acc = accs[0]
-    acc2 = acc.summary()
+    acc2 = dict(acc[0])
     acc2["session"] = token
-    return True, acc2, acc.privSummary()
+    return True, acc2, dict(acc[1])
 
 def allowedNickname(nickname):
     return not util.checkCurse(nickname)
 
 def updateAccount(session, username, data):
-    accs = session.query(Account).filter_by(username=username).all()
-    if 0==len(accs):
+    acc = session.query(Account).filter_by(username=username).first()
+    if acc is None:
         return (False, {}, "invalid account")
 
-    acc = accs[0]
     original = {"nickname": acc.nickname, "squad": acc.squad, "skin": acc.skin}   #to send rollback to user after a failed DB update
     changes = {}
 
@@ -188,8 +446,7 @@ def updateAccount(session, username, data):
     if "nickname" in data and len(data["nickname"])<=50 and data["nickname"] != acc.nickname:
         if not acc.isDev and not allowedNickname(data["nickname"]):
             return (False, original, "nickname not allowed")
-        dupenicks = session.query(Account).filter_by(nickname=data["nickname"]).all()
-        if 0<len(dupenicks):
+        if session.query(session.query(Account.id).filter_by(nickname=data["nickname"]).exists()).scalar():
             return (False, original, "nickname already in use")
         setNickname = True
 
@@ -205,62 +462,135 @@ def updateAccount(session, username, data):
         acc.skin = data["skin"]
         changes["skin"] = data["skin"]
     res = persistState(session)
+    accountCache.invalidate(username)
     if res:
         return (True, changes, "")
     else:
         return (False, original, "failed to save to database")
 
-def changePassword(session, username, password):
-    accs = session.query(Account).filter_by(username=username).all()
-    if 0==len(accs):
-        return
+def setPassword(session, username, salt, pwdhash):
+    acc = session.query(Account).filter_by(username=username).first()
+    if acc is None:
+        return False, "account not found"
+    acc.salt = salt
+    acc.pwdhash = pwdhash
+    res = persistState(session)
+    accountCache.invalidate(username)
+    if not res:
+        return False, "failed to save to database"
+    return True, ""
+
+def changePassword(username, password):
+    # Returns a Deferred that fires with (status, msg), like register and login
     if len(password) < 8:
-        return
+        return succeed((False, "password too short"))
     if len(password) > 120:
-        return
+        return succeed((False, "password too long"))
+    if not admitHash():
+        return succeed((False, BUSY_MSG))
 
-    salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
-    pwdhash = ph.hash(password.encode('utf-8')+salt)
+    salt = hashlib.sha256(os.urandom(60)).hexdigest()
+    d = runHash(hashPassword, password, salt)
+    d.addCallback(lambda pwdhash: defer(setPassword, username, salt, pwdhash))
+    return d.addBoth(releaseHash)
 
-    acc = accs[0]
-    acc.salt = salt
-    acc.pwdhash = pwdhash
-    persistState(session)
+def logout(token):
+    # Returns a Deferred
+    return deferCall(sessions.delete, token)
 
-def logout(dbSession, token):
-    if token in loggedInSessions:
-        del loggedInSessions[token]
+def banAccount(session, accId):
+    table = Account.__table__
+    session.execute(table.update().where(table.c.id == accId).values(isBanned=True))
+    session.commit()
+    invalidateAccounts([accId])
 
-def updateStats(session, accId, fields):
-    accs = session.query(Account).filter_by(id=accId).all()
-    if 0==len(accs):
-        return
-    acc = accs[0]
-    if "wins" in fields:
-        acc.wins += fields["wins"]
-    if "deaths" in fields:
-        acc.deaths += fields["deaths"]
-    if "kills" in fields:
-        acc.kills += fields["kills"]
-    if "coins" in fields:
-        acc.coins = max(0,acc.coins+fields["coins"])
-    if "isBanned" in fields:
-        acc.isBanned = fields["isBanned"]
-    if "nickname" in fields:
-        acc.nickname = fields["nickname"]
-    if "squad" in fields:
-        acc.squad = fields["squad"]
-    persistState(session)
-
-def getLeaderBoard():
-    session = DBSession()
+STATS_BATCH_KEEP = 7 * 24 * 3600
+
+def applyStats(session, rows):
+    # One executemany per kind of change for {account id: merged fields}
+    table = Account.__table__
+    counters, bans, renames = [], [], []
+    for accId, fields in rows.items():
+        if any(fields.get(x) for x in ("wins", "deaths", "kills", "coins", "coinsFloor")):
+            counters.append({"accId": accId, "dWins": fields.get("wins", 0), "dDeaths": fields.get("deaths", 0),
+                "dKills": fields.get("kills", 0), "dCoins": fields.get("coins", 0), "coinsFloor": fields.get("coinsFloor", 0)})
+        if "isBanned" in fields:
+            bans.append({"accId": accId, "newIsBanned": fields["isBanned"]})
+        if "nickname" in fields:
+            renames.append({"accId": accId, "newNickname": fields["nickname"], "newSquad": fields["squad"]})
+    byId = table.c.id == bindparam("accId")
+    if counters:
+        # see statsbuffer.mergeStats, the same as clamping at 0 after each merged change
+        coins = table.c.coins + bindparam("dCoins")
+        floor = bindparam("coinsFloor")
+        session.execute(table.update().where(byId).values(wins=table.c.wins + bindparam("dWins"),
+            deaths=table.c.deaths + bindparam("dDeaths"), kills=table.c.kills + bindparam("dKills"),
+            coins=case([(coins < floor, floor)], else_=coins)), counters)
+    if bans:
+        session.execute(table.update().where(byId).values(isBanned=bindparam("newIsBanned")), bans)
+    if renames:
+        session.execute(table.update().where(byId).values(nickname=bindparam("newNickname"), squad=bindparam("newSquad")), renames)
+
+def flushStats(session, rows, batchId):
+    # Writes the whole batch in one transaction. If that fails each account gets its own,
+    # so one bad row doesn't hold back the rest; rows the database rejects are dropped.
+    # The batch id, or batchId:accId for a row written on its own, is committed with the
+    # changes and whatever is already recorded is skipped, so replaying a journal that
+    # outlived its commit is harmless. Returns the rows that couldn't be written and
+    # should be retried, and the new totals of the accounts that were.
+    done = set(x.id for x in session.query(StatsBatch.id).filter((StatsBatch.id == batchId) | StatsBatch.id.like(batchId + ":%")))
+    if batchId in done:
+        return {}, getTotals(session, rows.keys())
+    todo = {accId: fields for accId, fields in rows.items() if "{0}:{1}".format(batchId, accId) not in done}
     try:
-        coinLB = session.query(Account).order_by(Account.coins.desc()).limit(10)
-        winsLB = session.query(Account).order_by(Account.wins.desc()).limit(10)
-        killsLB = session.query(Account).order_by(Account.kills.desc()).limit(10)
-        return {"coinLeaderBoard":[{"pos":i, "nickname": x.nickname, "coins": x.coins} for i,x in enumerate(coinLB, 1)],
-            "winsLeaderBoard":[{"pos":i, "nickname": x.nickname, "wins": x.wins} for i,x in enumerate(winsLB, 1)],
-            "killsLeaderBoard":[{"pos":i, "nickname": x.nickname, "kills": x.kills} for i,x in enumerate(killsLB, 1)]
-        }
-    finally:
-        session.close()
+        applyStats(session, todo)
+        session.add(StatsBatch(id=batchId, created=int(time.time())))
+        session.commit()
+        invalidateAccounts(todo)
+        return {}, getTotals(session, rows.keys())
+    except:
+        session.rollback()
+        traceback.print_exc()
+    failed = {}
+    for accId, fields in todo.items():
+        try:
+            applyStats(session, {accId: fields})
+            session.add(StatsBatch(id="{0}:{1}".format(batchId, accId), created=int(time.time())))
+            session.commit()
+        except (IntegrityError, DataError):
+            session.rollback()
+            print("dropping stats of account "+str(accId)+": "+json.dumps(fields))
+        except:
+            session.rollback()
+            failed[accId] = fields
+    invalidateAccounts(todo)
+    return failed, getTotals(session, [x for x in rows if x not in failed])
+
+def forgetStatsBatch(session, batchId):
+    # Called once the journal no longer holds the batch; also drops ids a crash left behind
+    table = StatsBatch.__table__
+    session.execute(table.delete().where((table.c.id == batchId) | table.c.id.like(batchId + ":%") |
+        (table.c.created < int(time.time()) - STATS_BATCH_KEEP)))
+    session.commit()
+
+def invalidateAccounts(accIds):
+    for accId in accIds:
+        accountCache.invalidate(accId=accId)
+
+def getTotals(session, accIds):
+    # The stats are committed by now, so a failure here must not fail the flush
+    accIds = list(accIds)
+    if not accIds:
+        return {}
+    try:
+        accs = session.query(Account.id, Account.nickname, Account.coins, Account.wins, Account.kills).filter(Account.id.in_(accIds)).all()
+    except:
+        session.rollback()
+        traceback.print_exc()
+        return {}
+    return {x.id: {"nickname": x.nickname, "coins": x.coins, "wins": x.wins, "kills": x.kills} for x in accs}
+
+def getTopAccounts(session, metric, count):
+    column = getattr(Account, metric)
+    accs = session.query(Account.id, Account.nickname, column).order_by(column.desc(), Account.id).limit(count)
+    return [(x[0], x[1], x[2]) for x in accs]
@@ -0,0 +1,65 @@
+METRICS = ("coins", "wins", "kills")
+NAMES = {"coins": "coinLeaderBoard", "wins": "winsLeaderBoard", "kills": "killsLeaderBoard"}
+
+class LeaderBoard(object):
+    # The top accounts for each metric, seeded from the database and then kept up to date
+    # from the account totals the stats buffer reads back after each flush. A metric is
+    # reseeded when an account on it loses points, since someone off the board might be
+    # ahead now, and when totals came in while its seed query was running.
+    def __init__(self, size=10):
+        self.size = size
+        self.boards = {metric: {} for metric in METRICS}    # metric -> {account id: (value, nickname)}
+        self.stale = set(METRICS)
+        self.dirty = set()  # stale metrics that got totals since their seed query was sent
+        self.changed = True
+
+    def seeding(self, metric):
+        self.dirty.discard(metric)
+
+    def seed(self, metric, rows):
+        board = {accId: (value, nickname) for accId, nickname, value in rows}
+        if board != self.boards[metric]:
+            self.boards[metric] = board
+            self.changed = True
+        # with fewer accounts than places, new accounts are only picked up by a seed
+        if metric not in self.dirty and len(board) >= self.size:
+            self.stale.discard(metric)
+
+    def update(self, totals):
+        # totals: {account id: {"nickname", "coins", "wins", "kills"}}
+        for metric in METRICS:
+            if metric in self.stale:
+                self.dirty.add(metric)
+                continue
+            board = self.boards[metric]
+            for accId, acc in totals.items():
+                entry = (acc[metric], acc["nickname"])
+                old = board.get(accId)
+                if old == entry:
+                    continue
+                if old is not None:
+                    if entry[0] < old[0]:
+                        self.stale.add(metric)
+                        break
+                    board[accId] = entry
+                    self.changed = True
+                    continue
+                last = min(board, key=lambda x: (board[x][0], -x))
+                if (entry[0], -accId) > (board[last][0], -last):
+                    del board[last]
+                    board[accId] = entry
+                    self.changed = True
+
+    def rename(self, accId, nickname):
+        for board in self.boards.values():
+            if accId in board and board[accId][1] != nickname:
+                board[accId] = (board[accId][0], nickname)
+                self.changed = True
+
+    def toJSON(self):
+        result = {}
+        for metric in METRICS:
+            board = self.boards[metric]
+            ranked = sorted(board, key=lambda x: (-board[x][0], x))
+            result[NAMES[metric]] = [{"pos":i, "nickname": board[x][1], metric: board[x][0]} for i,x in enumerate(ranked, 1)]
+        return result
@@ -0,0 +1,126 @@
+import json
+import util
+from array import array
+
+LOAD_MSG_CACHE_SIZE = 8
+
+def extractMainLayer(zone):
+    if "data" in zone:
+        return zone
+    elif "layers" in zone:
+        mainLayers = [x for x in zone["layers"] if x["z"] == 0]
+        if len(mainLayers) != 1:
+            raise Exception("invalid level - should have exactly one layer at depth 0")
+        return mainLayers[0]
+    else:
+        raise Exception("invalid level - neither data or layers present")
+
+def parseLevel(content, mtime=None):
+    # Parses, validates and indexes a level file or upload. It doesn't touch any shared
+    # state, so it is safe to run in a worker thread.
+    lk = json.loads(content)
+    util.validateLevel(lk)
+    if mtime is not None:
+        lk["mtime"] = mtime
+    return Level(lk)
+
+class Level(object):
+    # A level file prepared once when it is loaded and then shared by every match playing
+    # it, so nothing in here may be changed afterwards; matches keep their changed tiles in
+    # an overlay instead. The main layer of each zone lives in a flat uint32 array indexed
+    # by row*width+x (rows from the top, as in the file) and toJSON() puts it back.
+    def __init__(self, data):
+        self.data = data
+        self.mtime = data.get("mtime", 0)
+        self.type = data["type"]
+        self.mode = data["mode"]
+        self.shortname = data["shortname"]
+        # variant -> encoded g01 message, each a copy of the whole level, so only the few
+        # variants (gold flower placements) in use are kept
+        self.loadMsgs = util.LRUCache(LOAD_MSG_CACHE_SIZE)
+
+        def fixLayersZ(x):
+            if "data" in x:
+                x["layers"]=[{"z":0, "data":x["data"]}]
+                del x["data"]
+        for world in data["world"]:
+            for zone in world["zone"]:
+                fixLayersZ(zone)
+
+        self.tiles = []
+        self.zoneWidth = []
+        self.zoneHeight = []
+        self.coinBlocks = []    # (level, zone, index) of every coin block (id 18), where a gold flower can go
+        self.flagpoles = []     # per zone bitmap of flagpole tiles (id 160), None if the zone has none
+        self.allcoins = []      # per zone frozenset of coin object ids (type 97)
+        for level, world in enumerate(data["world"]):
+            tiles, widths, heights, flagpoles, coins = [], [], [], [], []
+            for zone, z in enumerate(world["zone"]):
+                layer = extractMainLayer(z)
+                rows = layer["data"]
+                zoneTiles = array('I')
+                for row in rows:
+                    zoneTiles.extend(row)
+                tiles.append(zoneTiles)
+                widths.append(len(rows[0]))
+                heights.append(len(rows))
+                layer["data"] = None
+
+                bitmap = None
+                for i, tile in enumerate(zoneTiles):
+                    id = (tile>>16)&0xff
+                    if id == 18:
+                        self.coinBlocks.append((level, zone, i))
+                    elif id == 160:
+                        if bitmap is None:
+                            bitmap = bytearray((len(zoneTiles) + 7) >> 3)
+                        bitmap[i >> 3] |= 1 << (i & 7)
+                flagpoles.append(bitmap)
+
+                objects = {x["pos"]:x["type"] for x in z["obj"]}
+                coins.append(frozenset(pos for pos, type in objects.items() if type == 97))
+            self.tiles.append(tiles)
+            self.zoneWidth.append(widths)
+            self.zoneHeight.append(heights)
+            self.flagpoles.append(flagpoles)
+            self.allcoins.append(coins)
+
+    def isFlagpole(self, level, zone, i):
+        bitmap = self.flagpoles[level][zone]
+        return bitmap is not None and (bitmap[i >> 3] >> (i & 7)) & 1 == 1
+
+    def getRows(self, level, zone, changes=None):
+        tiles = self.tiles[level][zone]
+        width = self.zoneWidth[level][zone]
+        rows = [tiles[i:i + width].tolist() for i in range(0, len(tiles), width)]
+        if changes:
+            for i, tile in changes.items():
+                rows[i // width][i % width] = tile
+        return rows
+
+    def toJSON(self, overlay=None):
+        # Builds the level as sent to clients. Only the containers on the way to a main
+        # layer are copied, everything else is shared with self.data.
+        changes = {}
+        for (level, zone, i), tile in (overlay or {}).items():
+            changes.setdefault((level, zone), {})[i] = tile
+        data = dict(self.data)
+        data["world"] = []
+        for level, world in enumerate(self.data["world"]):
+            world = dict(world)
+            zones = []
+            for zone, z in enumerate(world["zone"]):
+                z = dict(z)
+                z["layers"] = [dict(x, data=self.getRows(level, zone, changes.get((level, zone)))) if x["data"] is None else x for x in z["layers"]]
+                zones.append(z)
+            world["zone"] = zones
+            data["world"].append(world)
+        return data
+
+    def getLoadMsg(self, variant, encode):
+        # Encoded g01 messages are cached on the level, a reload replaces the whole object
+        msg = self.loadMsgs.get(variant)
+        if msg is None:
+            msg = encode()
+            self.loadMsgs.put(variant, msg)
+        return msg
@@ -1,10 +1,10 @@
 from twisted.internet import reactor, task
 from buffer import Buffer
+import packets
 import os
 import json
 import random
 import util
-import copy
 
 class Match(object):
     def __init__(self, server, roomName, private, gameMode):
@@ -30,6 +30,16 @@ class Match(object):
         self.winners = int()
         self.lastId = -1
         self.players = list()
+        self.playersById = {}
+        self.zonePlayers = {}    # (level, zone) -> loaded players in that zone
+        self.podiumPlayers = set()   # loaded players who reached the axe, they see every zone
+        self.playerListVersion = 0
+        self.playerListDeltas = self.server.playerListDeltas    # the setting the last player list was sent with
+        self.playerListAdded = {}    # changes since the last player list broadcast, for deltas
+        self.playerListRemoved = []
+        self.playerListUpdated = {}
+        self.zoneGrids = {}  # (level, zone) -> (cols, rows, cells) for area of interest culling
+        self.gridSize = self.server.interestRadius
         self.getRandomLevel("lobby", None)
         self.instantiateLevel()
         self.initLevel()
@@ -47,12 +57,25 @@ class Match(object):
 
     def addPlayer(self, player):
         self.players.append(player)
-        return self.getNextPlayerId()
+        if self.server.playerListDeltas:
+            self.playerListAdded[player] = None
+        pid = self.getNextPlayerId()
+        self.playersById[pid] = player
+        return pid
 
     def removePlayer(self, player):
         if player not in self.players:
             return
         self.players.remove(player)
+        if self.playersById.get(player.id) is player:
+            del self.playersById[player.id]
+        self.unindexPlayer(player)
+        if self.server.playerListDeltas:
+            if player in self.playerListAdded:
+                del self.playerListAdded[player]
+            else:
+                self.playerListRemoved.append(player.id)
+            self.playerListUpdated.pop(player, None)
         
         if len(self.players) == 0:
             try:
@@ -64,9 +87,10 @@ class Match(object):
                 self.tickTimer = None
             self.server.removeMatch(self)
             return
+        self.server.updateMatch(self) # it may be joinable again
         
         if not player.dead and not player.win: # Don't kill podium players
-            self.broadBin(0x11, Buffer().writeInt16(player.id)) # KILL_PLAYER_OBJECT
+            self.broadBin(0x11, packets.encode(0x11, player.id)) # KILL_PLAYER_OBJECT
 
         self.broadPlayerList()
 
@@ -76,20 +100,18 @@ class Match(object):
             self.start()
 
     def getPlayer(self, pid):
-        for player in self.players:
-            if player.id == pid:
-                return player
-        return None
+        return self.playersById.get(pid)
             
     def getWinners(self):
         self.winners += 1
         return self.winners
 
     def broadJSON(self, j):
+        msg = util.encodeJSON(j) #only serialize once!
         for player in self.players:
             if not player.loaded:
                 continue
-            player.sendJSON(j)
+            player.sendText(msg)
 
     def broadBin(self, code, buff, ignore = None):
         buff = buff.toBytes() if isinstance(buff, Buffer) else buff
@@ -99,11 +121,20 @@ class Match(object):
             player.sendBin(code, buff)
 
     def getLoadMsg(self):
+        if self.loadMsg is None:
+            if self.world == "custom" and self.loadMsgShared and not self.tilesChanged:
+                # Matches playing the same server level share one encoded message per gold flower placement
+                self.loadMsg = self.levelSource.getLoadMsg(self.goldFlower, self.encodeLoadMsg)
+            else:
+                self.loadMsg = self.encodeLoadMsg()
+        return self.loadMsg
+
+    def encodeLoadMsg(self):
         msg = {"game": self.world, "type": "g01"}
         if self.world == "custom":
-            msg["levelData"] = json.dumps(self.level)
+            msg["levelData"] = json.dumps(self.level.toJSON(self.tileOverlay))
         j = {"packets": [msg], "type": "s01"}
-        return json.dumps(j).encode('utf-8')
+        return util.encodeJSON(j)
 
     def broadLoadWorld(self):
         msg = self.getLoadMsg() #only serialize once!
@@ -116,10 +147,9 @@ class Match(object):
 
     def broadStartTimer(self, time):
         self.startTimer = time * 30
-        for player in self.players:
-            if not player.loaded:
-                continue
-            player.setStartTimer(self.startTimer)
+        self.broadJSON({"packets": [
+            {"time": self.startTimer, "type": "g13"}
+        ], "type": "s01"})
         
         if time > 0:
             reactor.callLater(1, self.broadStartTimer, time - 1)
@@ -128,21 +158,42 @@ class Match(object):
 
     def broadPlayerList(self):
         devOnly = self.playing   # Don't broad player list when in main game
-        playersData = self.getPlayersData(False);
-        playersDataDev = self.getPlayersData(True);
-        data = {"packets": [
-            {"players": playersData,
-             "type": "g12"}
-        ], "type": "s01"}
-        dataDev = {"packets": [
-            {"players": playersDataDev,
-             "type": "g12"}
-        ], "type": "s01"}
+        deltas = self.server.playerListDeltas
+        if deltas != self.playerListDeltas:
+            # A config reload switched deltas, the changes recorded since the last list
+            # don't cover it. Forget every player's version so they all get a snapshot.
+            self.playerListDeltas = deltas
+            for player in self.players:
+                player.playerListVersion = None
+        self.playerListVersion += 1
+        version = self.playerListVersion
+        added, removed, updated = self.playerListAdded, self.playerListRemoved, self.playerListUpdated
+        self.playerListAdded, self.playerListRemoved, self.playerListUpdated = {}, [], {}
+
+        msgs = {}
+        def getMsg(isDev, full):
+            # Every variant is built at most once and only if someone needs it
+            if (isDev, full) not in msgs:
+                if full:
+                    j = {"players": self.getPlayersData(isDev), "type": "g12"}
+                    if deltas:
+                        j["version"] = version
+                else:
+                    j = {"base": version - 1, "version": version, "type": "g14",
+                         "add": [x.getSimpleData(isDev) for x in added],
+                         "remove": removed,
+                         "update": [x.getSimpleData(isDev) for x in updated]}
+                msgs[(isDev, full)] = util.encodeJSON({"packets": [j], "type": "s01"})
+            return msgs[(isDev, full)]
+
         for player in self.players:
             if player.isDev or not devOnly:
                 if not player.loaded:
                     continue
-                player.sendJSON(data if not player.isDev else dataDev)
+                # Players who missed a version (or never had the list) get a full snapshot
+                full = not deltas or player.playerListVersion != version - 1
+                player.sendText(getMsg(player.isDev, full))
+                player.playerListVersion = version
 
     def getPlayersData(self, isDev):
         playersData = []
@@ -152,14 +203,95 @@ class Match(object):
             playersData.append(player.getSimpleData(isDev))
         return playersData
 
-    def broadPlayerUpdate(self, player, pktData):
-        data = Buffer().writeInt16(player.id).write(pktData).toBytes()
+    def indexPlayer(self, player):
+        key = (player.level, player.zone) if player.loaded else None
+        if player.zoneKey != key:
+            self.unindexPlayer(player)
+            if key is not None:
+                self.zonePlayers.setdefault(key, set()).add(player)
+                player.zoneKey = key
+        if key is not None and self.gridSize > 0:
+            cols, rows, cells = self.getGrid(key)
+            cx = min(max(int(player.posX) // self.gridSize, 0), cols - 1)
+            cy = min(max(int(player.posY) // self.gridSize, 0), rows - 1)
+            cell = cy * cols + cx
+            if player.gridCell != cell:
+                if player.gridCell is not None:
+                    cells[player.gridCell].discard(player)
+                cells[cell].add(player)
+                player.gridCell = cell
+        if player.loaded and player.win:
+            self.podiumPlayers.add(player)
+        else:
+            self.podiumPlayers.discard(player)
+
+    def unindexPlayer(self, player):
+        self.podiumPlayers.discard(player)
+        if player.zoneKey is None:
+            return
+        if player.gridCell is not None:
+            self.zoneGrids[player.zoneKey][2][player.gridCell].discard(player)
+            player.gridCell = None
+        bucket = self.zonePlayers[player.zoneKey]
+        bucket.discard(player)
+        if len(bucket) == 0:
+            del self.zonePlayers[player.zoneKey]
+        player.zoneKey = None
+
+    def getGrid(self, key):
+        grid = self.zoneGrids.get(key)
+        if grid is None:
+            level, zone = key
+            try:
+                width, height = self.zoneWidth[level][zone], self.zoneHeight[level][zone]
+            except IndexError:
+                width, height = 0, 0
+            cols = width // self.gridSize + 1
+            rows = height // self.gridSize + 1
+            grid = self.zoneGrids[key] = (cols, rows, [set() for i in range(cols * rows)])
+        return grid
+
+    def resetGrids(self):
+        self.gridSize = self.server.interestRadius
+        self.zoneGrids = {}
         for p in self.players:
-            if not p.loaded or p.id == player.id:
-                continue
-            if not p.win and (p.level != player.level or p.zone != player.zone):
-                continue
-            p.sendBin(0x12, data)
+            p.gridCell = None
+            if p.zoneKey is not None:
+                self.indexPlayer(p)
+
+    def getNearbyPlayers(self, player):
+        cols, rows, cells = self.getGrid(player.zoneKey)
+        cx, cy = player.gridCell % cols, player.gridCell // cols
+        r2 = self.gridSize * self.gridSize
+        for y in range(max(cy - 1, 0), min(cy + 2, rows)):
+            for x in range(max(cx - 1, 0), min(cx + 2, cols)):
+                for p in cells[y * cols + x]:
+                    dx = p.posX - player.posX
+                    dy = p.posY - player.posY
+                    if p is not player and dx * dx + dy * dy <= r2:
+                        yield p
+
+    def broadPlayerUpdate(self, player, pktData, cull=True):
+        if self.gridSize != self.server.interestRadius:
+            self.resetGrids()
+        data = packets.encode(0x12, player.id) + pktData
+        key = (player.level, player.zone)
+        player.updateCount += 1
+        farRate = self.server.interestFarRate
+        culled = cull and self.gridSize > 0 and player.gridCell is not None and (farRate <= 0 or player.updateCount % farRate != 0)
+        if culled:
+            # Players beyond the interest radius only get every farRate-th update, if any.
+            # Podium players get everything, they are sent to below.
+            for p in self.getNearbyPlayers(player):
+                if p not in self.podiumPlayers:
+                    p.sendBin(0x12, data)
+        else:
+            for p in self.zonePlayers.get(key, ()):
+                if p is not player:
+                    p.sendBin(0x12, data)
+        for p in self.podiumPlayers:
+            if p is not player and (culled or p.zoneKey != key):
+                p.sendBin(0x12, data)
 
     def onPlayerEnter(self, player):
         pass
@@ -196,16 +328,15 @@ class Match(object):
                 self.start()
 
     def onPlayerWarp(self, player, level, zone):
-        for p in self.players:
-            if not p.loaded or p.lastUpdatePkt is None or p.id == player.id:
-                continue
-            # Tell fellows that the player warped
-            if p.level == player.level and p.zone == player.zone:
-                p.sendBin(0x12, Buffer().writeInt16(player.id).writeInt8(level).writeInt8(zone).write(player.lastUpdatePkt[2:]))
+        # Tell fellows that the player warped
+        for p in self.zonePlayers.get((player.level, player.zone), ()):
+            if p.lastUpdatePkt is None or p is player:
                 continue
-            elif p.level != level or p.zone != zone:
+            p.sendBin(0x12, packets.encode(0x12, player.id) + bytes((level, zone)) + player.lastUpdatePkt[2:])
+        for p in self.zonePlayers.get((level, zone), ()):
+            if p.lastUpdatePkt is None or p is player:
                 continue
-            player.sendBin(0x12, Buffer().writeInt16(p.id).write(p.lastUpdatePkt))
+            player.sendBin(0x12, packets.encode(0x12, p.id) + p.lastUpdatePkt)
 
     def voteStart(self):
         self.votes += 1
@@ -243,63 +374,36 @@ class Match(object):
         reactor.callLater(1, self.broadStartTimer, self.server.startTimer)
 
     def instantiateLevel(self):
-        self.level = copy.deepcopy(self.customLevelData)
-        def fixLayersZ(x):
-            if "data" in x:
-                x["layers"]=[{"z":0, "data":x["data"]}]
-                del x["data"]
-        def fixLayersW(x):
-            [fixLayersZ(z) for z in x["zone"]]
-        [fixLayersW(w) for w in self.level["world"]]
+        # The level is shared with the server and other matches, tiles this match changes go to tileOverlay
+        self.level = self.levelSource = self.customLevelData
+        self.loadMsgShared = not self.usingCustomLevel
+        self.loadMsg = None
+        self.goldFlower = None
+        self.tilesChanged = False
+        self.tileOverlay = {}   # (level, zone, index) -> tile
+        self.tiles = self.level.tiles
+        self.zoneWidth = self.level.zoneWidth
+        self.zoneHeight = self.level.zoneHeight
 
     def addGoldFlower(self):
-        b = self.level
-        def g(a,b,c,x):
-            res = []
-            for i, e in enumerate(x):
-                for j, ee in enumerate(e):
-                    if ((ee>>16)&0xff) == 18:
-                        res.append((a,b,c,i,j))
-            return res
-        raze = lambda x:[item for sublist in x for item in sublist]
-        f = lambda a,b,x:[[] if l["z"]!=0 else g(a,b,i,l["data"]) for i,l in enumerate(x)]
-        c = [[f(x["id"],y["id"],y["layers"]) for y in x["zone"]] for x in b["world"]]
-        e = raze(raze(raze(c)))
+        e = self.level.coinBlocks
         if len(e)==0:
             return
         target = random.choice(e)
-        v = b["world"][target[0]]["zone"][target[1]]["layers"][target[2]]["data"][target[3]][target[4]]
-        v = (v&0xffff) | (100 << 24) | (17 << 16)
-        self.level["world"][target[0]]["zone"][target[1]]["layers"][target[2]]["data"][target[3]][target[4]]=v
+        v = self.tiles[target[0]][target[1]][target[2]]
+        self.tileOverlay[target] = (v&0xffff) | (100 << 24) | (17 << 16)
+        self.goldFlower = target
+        self.loadMsg = None
 
     def initLevel(self):
         self.initObjects()
 
-    def extractMainLayer(self, zone):
-        if "data" in zone:
-            return zone["data"]
-        elif "layers" in zone:
-            mainLayers = [x for x in zone["layers"] if x["z"] == 0]
-            if len(mainLayers) != 1:
-                raise Exception("invalid level - should have exactly one layer at depth 0")
-            return mainLayers[0]["data"]
-        else:
-            raise Exception("invalid level - neither data or layers present")
-
     def initObjects(self):
-        self.objects = [(lambda x:[(lambda x:{x["pos"]:x["type"] for x in x["obj"]})(x) for x in x["zone"]])(x) for x in self.level["world"]]
-        self.allcoins = [(lambda x:[(lambda x:[y for y in x if x[y]==97])(x) for x in x])(x) for x in self.objects]
-        self.tiles = [(lambda x:[self.extractMainLayer(x) for x in x["zone"]])(x) for x in self.level["world"]]
-        self.zoneHeight = [[len(y) for y in x] for x in self.tiles]
-        self.zoneWidth = [[len(y[0]) for y in x] for x in self.tiles]
-        self.coins = copy.deepcopy(self.allcoins)
+        self.allcoins = self.level.allcoins
+        self.resetGrids()
+        self.coinsTaken = set()  # (level, zone, oid) of coins picked up in this match
         self.powerups = {}
 
-    def validateCustomLevel(self, level):
-        lk = json.loads(level)
-        util.validateLevel(lk)
-        return lk
-
     def selectLevel(self, level):
         if level == "" or level in self.server.levels:
             self.forceLevel = level
@@ -307,65 +411,85 @@ class Match(object):
             self.broadLevelSelect()
 
     def broadLevelSelect(self):
-        data = {"type":"gsl", "name":self.forceLevel, "status":"update", "message":""}
+        data = util.encodeJSON({"type":"gsl", "name":self.forceLevel, "status":"update", "message":""})
         for player in self.players:
-            player.sendJSON(data)
+            player.sendText(data)
 
-    def selectCustomLevel(self, level):
-        lk = self.validateCustomLevel(level)
+    def selectCustomLevel(self, lv):
         self.usingCustomLevel = True
         self.forceLevel = "custom"
-        self.customLevelData = lk
+        self.customLevelData = lv
         self.broadLevelSelect()
 
-    def objectEventTrigger(self, player, b, pktData):
-        level, zone, oid, type = b.readInt8(), b.readInt8(), b.readInt32(), b.readInt8()
-        allcoins = self.allcoins[level][zone]
-        if oid in allcoins:
-            coins = self.coins[level][zone]
-            if not oid in coins:
+    def objectEventTrigger(self, player, fields, pktData):
+        level, zone, oid, type = fields
+        if oid in self.allcoins[level][zone]:
+            coin = (level, zone, oid)
+            if coin in self.coinsTaken:
                 return
             player.addCoin()
-            coins.remove(oid)
+            self.coinsTaken.add(coin)
         if oid in self.powerups:
             powerup = self.powerups[oid]
             if powerup["type"] == 100:
                 player.addLeaderBoardCoins(50000)
             del self.powerups[oid]
 
-        self.broadBin(0x20, Buffer().writeInt16(player.id).write(pktData))
+        self.broadBin(0x20, packets.encode(0x20, player.id) + pktData)
 
     def getTile(self, level, zone, x, y):
-        if x<0 or y<0 or x>=self.zoneWidth[level][zone] or y>=self.zoneHeight[level][zone]:
+        width = self.zoneWidth[level][zone]
+        height = self.zoneHeight[level][zone]
+        if x<0 or y<0 or x>=width or y>=height:
             return 30
-        return self.tiles[level][zone][self.zoneHeight[level][zone]-1-y][x]
-
-    def tileEventTrigger(self, player, b, pktData):
-
-        level, zone, pos, type = b.readInt8(), b.readInt8(), b.readShor2(), b.readInt8()
-        x = pos[0]
-        y0 = pos[1]
+        i = (height-1-y)*width + x
+        if self.tileOverlay:
+            tile = self.tileOverlay.get((level, zone, i))
+            if tile is not None:
+                return tile
+        return self.tiles[level][zone][i]
+
+    def isFlagpole(self, level, zone, x, y):
+        width = self.zoneWidth[level][zone]
+        height = self.zoneHeight[level][zone]
+        if x<0 or y<0 or x>=width or y>=height:
+            return False
+        return self.level.isFlagpole(level, zone, (height-1-y)*width + x)
+
+    def setTile(self, level, zone, x, y, tile):
+        # Late joiners must see the changed level, so it can't use the shared load message anymore
+        self.tileOverlay[(level, zone, y*self.zoneWidth[level][zone] + x)] = tile
+        self.tilesChanged = True
+        self.loadMsg = None
+
+    def tileEventTrigger(self, player, fields, pktData):
+        level, zone, y0, x, type = fields
+        width = self.zoneWidth[level][zone]
         y = self.zoneHeight[level][zone]-1-y0
-        tile = self.tiles[level][zone][y][x]
+        if x<0 or y0<0 or y<0 or x>=width:
+            return
+        tile = self.tileOverlay.get((level, zone, y*width + x))
+        if tile is None:
+            tile = self.tiles[level][zone][y*width + x]
         id = (tile>>16)&0xff
         extraData = (tile>>24)&0xff
         if id==18 or id==22:    #normal and hidden coin blocks
             player.addCoin()
-            self.tiles[level][zone][y][x] = 98331
+            self.setTile(level, zone, x, y, 98331)
         elif id==17:    #normal item block
             oid = x|(y0<<16)    #erroneously(?) uses y0 instead of y
             self.powerups[oid] = {"id":oid, "type": extraData}
-            self.tiles[level][zone][y][x] = 98331
+            self.setTile(level, zone, x, y, 98331)
         elif id==19:    #multi-coin block
             if extraData > 1:
                 player.addCoin()
-                self.tiles[level][zone][y][x] = (tile&0xffffff)|((extraData-1)<<24)
+                self.setTile(level, zone, x, y, (tile&0xffffff)|((extraData-1)<<24))
             else:
                 if extraData == 1:
                     player.addCoin()
-                self.tiles[level][zone][y][x] = 98331
+                self.setTile(level, zone, x, y, 98331)
 
-        self.broadBin(0x30, Buffer().writeInt16(player.id).write(pktData))
+        self.broadBin(0x30, packets.encode(0x30, player.id) + pktData)
 
     def banPlayer(self, pid, ban):
         player = self.getPlayer(pid)
@@ -380,6 +504,8 @@ class Match(object):
         if player.isDev:
             return
         player.rename(newName)
+        if self.server.playerListDeltas and player not in self.playerListAdded:
+            self.playerListUpdated[player] = None
         self.broadJSON({"type":"gnm", "pid":pid, "name":newName})
 
     def resquadPlayer(self, pid, newName):
@@ -389,11 +515,14 @@ class Match(object):
         if player.isDev:
             return
         player.resquad(newName)
+        if self.server.playerListDeltas and player not in self.playerListAdded:
+            self.playerListUpdated[player] = None
         self.broadJSON({"type":"gsq", "pid":pid, "name":newName})
 
     def hurryUp(self, time):
+        msg = util.encodeJSON({"type":"ghu", "time": time})
         for player in self.players:
-            player.hurryUp(time)
+            player.hurryUp(time, msg)
 
     def tick(self):
         if (self.autoStartOn):
@@ -0,0 +1,75 @@
+import heapq
+
+class MatchDirectory(object):
+    # Joinable matches indexed by (gameMode, private, roomName). Each key has a heap
+    # ordered by creation, so a join gets the oldest joinable match like the old linear
+    # scan did. Matches that fill up, close or start are dropped from the heap lazily
+    # when they reach the top, update() puts them back once they are joinable again.
+    def __init__(self, server):
+        self.server = server
+        self.matches = {}   # match -> creation sequence
+        self.heaps = {}     # key -> [(seq, match)]
+        self.queued = set() # matches that currently have a heap entry
+        self.keyCounts = {} # key -> live matches, so heaps of dead keys can be dropped
+        self.nextSeq = 0
+
+    def __len__(self):
+        return len(self.matches)
+
+    def __iter__(self):
+        return iter(list(self.matches))
+
+    def __contains__(self, match):
+        return match in self.matches
+
+    def getKey(self, gameMode, private, roomName):
+        return (gameMode, private, roomName if private else "")
+
+    def matchKey(self, match):
+        return self.getKey(match.gameMode, match.private, match.roomName)
+
+    def isJoinable(self, match):
+        if match.closed or len(match.players) >= self.server.playerCap:
+            return False
+        return self.server.allowLateEnter or not match.playing
+
+    def find(self, roomName, private, gameMode):
+        heap = self.heaps.get(self.getKey(gameMode, private, roomName))
+        while heap:
+            match = heap[0][1]
+            if match in self.matches and self.isJoinable(match):
+                return match
+            heapq.heappop(heap)
+            self.queued.discard(match)
+        return None
+
+    def add(self, match):
+        key = self.matchKey(match)
+        self.matches[match] = self.nextSeq
+        self.nextSeq += 1
+        self.keyCounts[key] = self.keyCounts.get(key, 0) + 1
+        self.update(match)
+
+    def remove(self, match):
+        if match not in self.matches:
+            return
+        del self.matches[match]
+        self.queued.discard(match)
+        key = self.matchKey(match)
+        self.keyCounts[key] -= 1
+        if self.keyCounts[key] == 0:
+            del self.keyCounts[key]
+            self.heaps.pop(key, None)
+
+    def update(self, match):
+        if match in self.queued or match not in self.matches or not self.isJoinable(match):
+            return
+        heapq.heappush(self.heaps.setdefault(self.matchKey(match), []), (self.matches[match], match))
+        self.queued.add(match)
+
+    def refresh(self):
+        # rebuild every heap, needed when PlayerCap or AllowLateEnter changes
+        self.heaps = {}
+        self.queued = set()
+        for match in self.matches:
+            self.update(match)
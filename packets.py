@@ -0,0 +1,38 @@
+import struct
+
+# Inbound packet bodies (everything after the opcode byte). Each one is decoded with a
+# single unpack_from straight from the receive buffer. Note that shor2 positions are
+# sent in (y, x) order.
+DECODERS = {
+    0x10: struct.Struct("!BBhh"),   # CREATE_PLAYER_OBJECT: level, zone, posY, posX
+    0x11: struct.Struct("!"),       # KILL_PLAYER_OBJECT
+    0x12: struct.Struct("!BBffBB"), # UPDATE_PLAYER_OBJECT: level, zone, posX, posY, sprite, reverse
+    0x13: struct.Struct("!B"),      # PLAYER_OBJECT_EVENT: type
+    0x17: struct.Struct("!H"),      # killer
+    0x18: struct.Struct("!4x"),     # PLAYER_RESULT_REQUEST
+    0x19: struct.Struct("!"),
+    0x20: struct.Struct("!BBIB"),   # OBJECT_EVENT_TRIGGER: level, zone, oid, type
+    0x30: struct.Struct("!BBhhB"),  # TILE_EVENT_TRIGGER: level, zone, posY, posX, type
+}
+
+# Outbound packet bodies. Relayed packets (0x12, 0x13, 0x17, 0x20, 0x30) only encode the
+# sender's pid here, the original packet body is appended as is.
+ENCODERS = {
+    0x02: struct.Struct("!HHB"),    # ASSIGN_PID: pid, skin, isDev
+    0x10: struct.Struct("!HBBhhHB"),# CREATE_PLAYER_OBJECT: pid, level, zone, posY, posX, skin, isDev
+    0x11: struct.Struct("!H"),      # KILL_PLAYER_OBJECT: pid
+    0x12: struct.Struct("!H"),      # UPDATE_PLAYER_OBJECT: pid
+    0x13: struct.Struct("!H"),      # PLAYER_OBJECT_EVENT: pid
+    0x17: struct.Struct("!H"),      # pid
+    0x18: struct.Struct("!HBB"),    # PLAYER_RESULT: pid, pos, 0
+    0x20: struct.Struct("!H"),      # OBJECT_EVENT_TRIGGER: pid
+    0x21: struct.Struct("!B"),      # coin
+    0x22: struct.Struct("!i"),      # leaderboard coins
+    0x30: struct.Struct("!H"),      # TILE_EVENT_TRIGGER: pid
+}
+
+def decode(code, data, offset=0):
+    return DECODERS[code].unpack_from(data, offset)
+
+def encode(code, *fields):
+    return ENCODERS[code].pack(*fields)
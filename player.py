@@ -3,7 +3,7 @@
 import re
 import emoji
 from twisted.internet import reactor
-from buffer import Buffer
+import packets
 import util
 
 try:
@@ -39,6 +39,10 @@ class Player(object):
         self.voted = bool()
         self.loaded = bool()
         self.lobbier = bool()
+        self.zoneKey = None
+        self.playerListVersion = None
+        self.gridCell = None
+        self.updateCount = 0
         self.lastUpdatePkt = None
         self.wins = 0
         self.deaths = 0
@@ -68,11 +72,12 @@ class Player(object):
         return result
 
     def serializePlayerObject(self):
-        return Buffer().writeInt16(self.id).writeInt8(self.level).writeInt8(self.zone).writeShor2(self.posX, self.posY).writeInt16(self.skin).writeInt8(self.isDev).toBytes()
+        return packets.encode(0x10, self.id, self.level, self.zone, int(self.posY), int(self.posX), self.skin, self.isDev)
 
     def loadWorld(self, worldName, loadMsg):
         self.dead = True
         self.loaded = False
+        self.match.indexPlayer(self)
         self.pendingWorld = worldName
         self.sendText(loadMsg)
         self.client.startDCTimer(15)
@@ -95,7 +100,7 @@ class Player(object):
 
     def sendLevelSelect(self):
         levelList = self.server.getLevelList("game", self.match.levelMode)
-        levelDicts = [{"shortId":self.server.levels[x]["shortname"], "longId":x} for x in levelList]
+        levelDicts = [{"shortId":self.server.levels[x].shortname, "longId":x} for x in levelList]
         levelDicts.sort(key=lambda x: x["shortId"])
         self.sendJSON({"type": "gll", "levels": levelDicts})
 
@@ -116,18 +121,20 @@ class Player(object):
         self.pendingWorld = None
         self.lastXOk = True
         self.flagTouched = False
+        self.match.indexPlayer(self)
         
-        self.sendBin(0x02, Buffer().writeInt16(self.id).writeInt16(self.skin).writeInt8(self.isDev)) # ASSIGN_PID
+        self.sendBin(0x02, packets.encode(0x02, self.id, self.skin, self.isDev)) # ASSIGN_PID
 
         self.match.onPlayerReady(self)
 
-    def handlePkt(self, code, b, pktData):
+    def handlePkt(self, code, fields, pktData):
         if code == 0x10: # CREATE_PLAYER_OBJECT
-            level, zone, pos = b.readInt8(), b.readInt8(), b.readShor2()
+            level, zone, posY, posX = fields
             self.level = level
             self.zone = zone
-            self.posX = pos[0]
-            self.posY = pos[1]
+            self.posX = posX
+            self.posY = posY
+            self.match.indexPlayer(self)
 
             self.dead = False
             self.client.stopDCTimer()
@@ -141,14 +148,14 @@ class Player(object):
             self.client.startDCTimer(60)
 
             self.addDeath()
-            self.match.broadBin(0x11, Buffer().writeInt16(self.id))
+            self.match.broadBin(0x11, packets.encode(0x11, self.id))
             self.addLeaderBoardCoins(-10)
 
         elif code == 0x12: # UPDATE_PLAYER_OBJECT
             if self.dead or self.lastUpdatePkt == pktData:
                 return
 
-            level, zone, pos, sprite, reverse = b.readInt8(), b.readInt8(), b.readVec2(), b.readInt8(), b.readBool()
+            level, zone, posX, posY, sprite, reverse = fields
 
             if self.level != level or self.zone != zone:
                 self.match.onPlayerWarp(self, level, zone)
@@ -157,14 +164,14 @@ class Player(object):
                 self.flagTouched = False
             self.level = level
             self.zone = zone
-            self.posX = pos[0]
-            self.posY = pos[1]
-            tile = self.match.getTile(level,zone,int(self.posX),int(self.posY))
-            tileDef = (tile>>16)&0xff
-            extraData = (tile>>24)&0xff
-            if (tileDef == 160 and extraData == 1 and not self.flagTouched):
-                self.addLeaderBoardCoins(self.server.coinRewardFlagpole)
-            if (tileDef == 160):
+            self.posX = posX
+            self.posY = posY
+            self.match.indexPlayer(self)
+            if self.match.isFlagpole(level,zone,int(self.posX),int(self.posY)):
+                tile = self.match.getTile(level,zone,int(self.posX),int(self.posY))
+                extraData = (tile>>24)&0xff
+                if (extraData == 1 and not self.flagTouched):
+                    self.addLeaderBoardCoins(self.server.coinRewardFlagpole)
                 self.flagTouched = True
             self.lastUpdatePkt = pktData
 
@@ -178,16 +185,16 @@ class Player(object):
             if self.dead or self.win:
                 return
 
-            type = b.readInt8()
+            type, = fields
 
             if self.match.world == "lobby":
                 self.client.block(0x2)
                 return
             
-            self.match.broadBin(0x13, Buffer().writeInt16(self.id).write(pktData))
+            self.match.broadBin(0x13, packets.encode(0x13, self.id) + pktData)
 
         elif code == 0x17:
-            killer = b.readInt16()
+            killer, = fields
             if self.id == killer:
                 return
             
@@ -196,7 +203,7 @@ class Player(object):
                 return
 
             killer.addKill()
-            killer.sendBin(0x17, Buffer().writeInt16(self.id).write(pktData))
+            killer.sendBin(0x17, packets.encode(0x17, self.id) + pktData)
             killer.addLeaderBoardCoins(10)
 
         elif code == 0x18: # PLAYER_RESULT_REQUEST
@@ -204,6 +211,7 @@ class Player(object):
                 return
 
             self.win = True
+            self.match.indexPlayer(self)
             self.client.startDCTimer(120)
 
             pos = self.match.getWinners()
@@ -224,7 +232,7 @@ class Player(object):
                 pass
 
             # Make sure that everyone knows that the player is at the axe
-            self.match.broadPlayerUpdate(self, self.lastUpdatePkt)
+            self.match.broadPlayerUpdate(self, self.lastUpdatePkt, False)
 
             if pos == 1:
                 self.addLeaderBoardCoins(self.server.coinRewardPodium1)
@@ -232,7 +240,7 @@ class Player(object):
                 self.addLeaderBoardCoins(self.server.coinRewardPodium2)
             elif pos == 3:
                 self.addLeaderBoardCoins(self.server.coinRewardPodium3)
-            self.match.broadBin(0x18, Buffer().writeInt16(self.id).writeInt8(pos).writeInt8(0))
+            self.match.broadBin(0x18, packets.encode(0x18, self.id, pos & 0xFF, 0))
             
         elif code == 0x19:
             self.trustCount += 1
@@ -243,18 +251,18 @@ class Player(object):
             if self.dead:
                 return
 
-            self.match.objectEventTrigger(self, b, pktData)
+            self.match.objectEventTrigger(self, fields, pktData)
             
         elif code == 0x30: # TILE_EVENT_TRIGGER
             if self.dead:
                 return
 
-            self.match.tileEventTrigger(self, b, pktData)
+            self.match.tileEventTrigger(self, fields, pktData)
 
     def addCoin(self):
         if not self.lobbier:
             self.coins += 1
-        self.sendBin(0x21, Buffer().writeInt8(0))
+        self.sendBin(0x21, packets.encode(0x21, 0))
 
     def addWin(self):
         if not self.lobbier:
@@ -284,14 +292,14 @@ class Player(object):
         self.team = newName
         self.forceRenamed = True
 
-    def hurryUp(self, time):
+    def hurryUp(self, time, msg):
         if self.hurryingUp:
             return
         self.hurryingUp = True
-        self.sendJSON({"type":"ghu", "time": time})
+        self.sendText(msg)
         self.client.startDCTimerIndependent(time+30)
 
     def addLeaderBoardCoins(self, coins):
         if not self.lobbier:
             self.coins += coins
-        self.sendBin(0x22, Buffer().writeInt32(coins))
+        self.sendBin(0x22, packets.encode(0x22, coins))
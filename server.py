@@ -12,7 +12,7 @@ if sys.version_info.major != 3:
     exit(1)
 
 from twisted.python import log
-from twisted.internet import task
+from twisted.internet import task, threads, defer
 log.startLogging(sys.stdout)
 
 from autobahn.twisted import install_reactor
@@ -34,7 +34,15 @@ except:
     print("Can't import captcha, captcha functioning will be disabled.")
     CP_IMPORT = False
 
+try:
+    from twisted.internet import inotify
+    from twisted.python import filepath
+    INOTIFY_IMPORT = True
+except Exception as e:
+    INOTIFY_IMPORT = False
+
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
 from twisted.internet.protocol import Factory
 import json
 import jsonschema
@@ -44,10 +52,19 @@ import base64
 import hashlib
 import traceback
 import configparser
+import time
+import zlib
 from io import BytesIO
 from buffer import Buffer
 from player import Player
+import packets
 from match import Match
+from level import parseLevel
+from matchdirectory import MatchDirectory
+from banlist import BanList
+from statsbuffer import StatsBuffer
+from leaderboard import LeaderBoard
+from collections import Counter
 
 NUM_GM = 3
 
@@ -58,6 +75,7 @@ class MyServerProtocol(WebSocketServerProtocol):
         self.server = server
         self.address = str()
         self.recv = bytearray()
+        self.outbox = bytearray()
 
         self.pendingStat = None
         self.stat = str()
@@ -70,7 +88,8 @@ class MyServerProtocol(WebSocketServerProtocol):
 
         self.dcTimer = None
         #self.maxConLifeTimer = None
-        self.dbSession = datastore.getDbSession()
+        self.dbPending = False
+        self.disconnected = False
 
     def startDCTimerIndependent(self, time):
         reactor.callLater(time, self.sendClose2)
@@ -117,12 +136,14 @@ class MyServerProtocol(WebSocketServerProtocol):
         #except:
         #    pass
         self.stopDCTimer()
+        self.outbox.clear()
+        self.disconnected = True
 
         if self.address in self.server.captchas:
             del self.server.captchas[self.address]
 
         if self.username != "" and self.username in self.server.authd:
-            self.server.authd.remove(self.username)
+            self.server.authd.discard(self.username)
 
         if self.stat == "g" and self.player != None:
             if self.username != "":
@@ -137,19 +158,34 @@ class MyServerProtocol(WebSocketServerProtocol):
                     if self.player.coins != 0:
                         changed["coins"] = self.player.coins
                 if self.blocked:
-                    changed["isBanned"] = True
+                    self.server.banAccount(self.accountPriv["id"])
                 if self.player.forceRenamed:
                     changed["nickname"] = self.player.name
                     changed["squad"] = self.player.team
                 if 0<len(changed):
-                    datastore.updateStats(self.dbSession, self.accountPriv["id"], changed)
-            self.server.players.remove(self.player)
+                    self.server.stats.add(self.accountPriv["id"], changed)
+            self.server.removePlayer(self.player)
             self.player.match.removePlayer(self.player)
             self.player.match = None
             self.player = None
             self.pendingStat = None
             self.stat = str()
-        self.dbSession.close()
+
+    def dbCall(self, callback, d):
+        # Passes the result of a datastore Deferred to callback, unless the connection is
+        # gone by then. Until it is done, the handlers refuse further requests from this
+        # connection.
+        self.dbPending = True
+        def done(result):
+            self.dbPending = False
+            if not self.disconnected:
+                callback(result)
+        def failed(failure):
+            self.dbPending = False
+            log.err(failure, "datastore call failed")
+            if not self.disconnected:
+                self.sendClose2()
+        d.addCallbacks(done, failed).addErrback(log.err)
 
     def onMessage(self, payload, isBinary):
         if len(payload) == 0:
@@ -159,10 +195,17 @@ class MyServerProtocol(WebSocketServerProtocol):
 
         try:
             if isBinary:
-                self.recv += payload
-                while len(self.recv) > 0:
-                    if not self.onBinaryMessage():
-                        break
+                data = payload
+                if len(self.recv) > 0:
+                    self.recv += payload
+                    data = self.recv
+                pos = self.onBinaryMessage(data)
+                # Only an incomplete trailing packet is kept for the next message, so recv
+                # never holds more than one packet
+                if data is self.recv:
+                    del self.recv[:pos]
+                elif pos < len(data):
+                    self.recv += data[pos:]
             else:
                 self.onTextMessage(payload.decode('utf8'))
         except Exception as e:
@@ -174,17 +217,53 @@ class MyServerProtocol(WebSocketServerProtocol):
     def sendJSON(self, j):
         self.server.out_messages += 1
         #print("sendJSON: "+str(j))
-        self.sendMessage(json.dumps(j).encode('utf-8'), False)
+        self.flushOutbox()
+        self.sendPayload(util.encodeJSON(j), False)
 
     def sendText(self, t):
         self.server.out_messages += 1
-        self.sendMessage(t, False)
+        self.flushOutbox()
+        self.sendPayload(t, False)
 
     def sendBin(self, code, buff):
         self.server.out_messages += 1
-        msg=Buffer().writeInt8(code).write(buff.toBytes() if isinstance(buff, Buffer) else buff).toBytes()
+        buff = buff.toBytes() if isinstance(buff, Buffer) else buff
+        if self.server.outboxTimer is not None:
+            # Batching mode: packets are concatenated and sent as one frame on the next tick
+            if len(self.outbox) == 0:
+                self.server.pendingOutboxes.append(self)
+            self.outbox.append(code)
+            self.outbox += buff
+            return
+        msg=bytes((code,)) + buff
         #print("sendBin: "+str(code)+" "+str(msg))
-        self.sendMessage(msg, True)
+        self.sendPayload(msg, True)
+
+    def flushOutbox(self):
+        if len(self.outbox) == 0:
+            return
+        msg = bytes(self.outbox)
+        self.outbox.clear()
+        if self.state != WebSocketServerProtocol.STATE_OPEN:
+            return
+        self.sendPayload(msg, True)
+
+    def sendPayload(self, payload, isBinary):
+        pmce = self._perMessageCompress
+        if pmce is None or not pmce.server_no_context_takeover or len(payload) < self.server.compressionThreshold:
+            self.sendMessage(payload, isBinary, doNotCompress=True)
+            return
+        if self.state != WebSocketServerProtocol.STATE_OPEN:
+            return
+        # Without context takeover every message is deflated on its own, so the same
+        # payload (a level load, or one broadcast going to a whole match) compresses to
+        # the same bytes for every client and is only deflated once.
+        data = self.server.compressPayload(payload, pmce.server_max_window_bits, pmce.mem_level)
+        if self.trafficStats:
+            self.trafficStats.outgoingWebSocketMessages += 1
+            self.trafficStats.outgoingOctetsAppLevel += len(payload)
+            self.trafficStats.outgoingOctetsWebSocketLevel += len(data)
+        self.sendFrame(opcode=2 if isBinary else 1, payload=data, rsv=4)
 
     def loginSuccess(self):
         self.sendJSON({"packets": [
@@ -208,7 +287,7 @@ class MyServerProtocol(WebSocketServerProtocol):
         print("Player blocked: {0}".format(self.player.name))
         self.blocked = True
         if not self.player.dead:
-            self.player.match.broadBin(0x11, Buffer().writeInt16(self.player.id), self.player.id) # KILL_PLAYER_OBJECT
+            self.player.match.broadBin(0x11, packets.encode(0x11, self.player.id), self.player.id) # KILL_PLAYER_OBJECT
         self.server.blockAddress(self.address, self.player.name, reason)
 
     def onTextMessage(self, payload):
@@ -218,7 +297,7 @@ class MyServerProtocol(WebSocketServerProtocol):
 
         if self.stat == "l":
             if type == "l00": # Input state ready
-                if self.player is not None or self.pendingStat is None:
+                if self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 self.pendingStat = None
@@ -231,11 +310,10 @@ class MyServerProtocol(WebSocketServerProtocol):
                 if self.server.shuttingDown:
                     self.setState("g") # Ingame
                     return
-                for b in self.server.blocked:
-                    if b[0] == self.address:
-                        self.blocked = True
-                        self.setState("g") # Ingame
-                        return
+                if self.address in self.server.blocked:
+                    self.blocked = True
+                    self.setState("g") # Ingame
+                    return
                 if self.username != "":
                     if self.accountPriv["isBanned"]:
                         self.blocked = True
@@ -263,12 +341,12 @@ class MyServerProtocol(WebSocketServerProtocol):
                 #if priv:
                 #    self.maxConLifeTimer.cancel()
                 self.loginSuccess()
-                self.server.players.append(self.player)
+                self.server.addPlayer(self.player)
                 
                 self.setState("g") # Ingame
 
             elif type == "llg": #login
-                if self.username != "" or self.player is not None or self.pendingStat is None:
+                if self.username != "" or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 self.stopDCTimer()
@@ -281,59 +359,64 @@ class MyServerProtocol(WebSocketServerProtocol):
                     self.sendJSON({"type": "llg", "status": False, "msg": "account already in use"})
                     return
 
-                status, msg, self.accountPriv = datastore.login(self.dbSession, username, packet["password"])
-
-                j = {"type": "llg", "status": status, "msg": msg}
-                if status:
-                    self.account = msg
-                    j["username"] = self.username = username
-                    self.session = msg["session"]
-                    self.server.authd.append(self.username)
-                else:
-                    if self.address not in self.server.maxLoginTries:
-                        self.server.maxLoginTries[self.address] = 1
-                    else:
-                        self.server.maxLoginTries[self.address] += 1
-                        if self.server.maxLoginTries[self.address] >= 4:
-                            del self.server.maxLoginTries[self.address]
-                            self.server.loginBlocked.append(self.address)
-                            reactor.callLater(60, self.server.loginBlocked.remove, self.address)
-                self.sendJSON(j)
+                def loggedIn(result):
+                    status, msg, self.accountPriv = result
+                    j = {"type": "llg", "status": status, "msg": msg}
+                    if status:
+                        if username in self.server.authd: # logged in elsewhere while we waited
+                            datastore.logout(msg["session"]).addErrback(log.err)
+                            self.sendJSON({"type": "llg", "status": False, "msg": "account already in use"})
+                            return
+                        self.account = msg
+                        j["username"] = self.username = username
+                        self.session = msg["session"]
+                        self.server.authd.add(self.username)
+                    elif msg != datastore.BUSY_MSG:
+                        if self.address not in self.server.maxLoginTries:
+                            self.server.maxLoginTries[self.address] = 1
+                        else:
+                            self.server.maxLoginTries[self.address] += 1
+                            if self.server.maxLoginTries[self.address] >= 4:
+                                del self.server.maxLoginTries[self.address]
+                                self.server.loginBlocked.add(self.address)
+                    self.sendJSON(j)
+                self.dbCall(loggedIn, datastore.login(username, packet["password"]))
 
             elif type == "llo": #logout
-                if self.username == "" or self.player is not None or self.pendingStat is None:
+                if self.username == "" or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 
-                datastore.logout(self.dbSession, self.session)
+                datastore.logout(self.session).addErrback(log.err)
                 self.sendJSON({"type": "llo"})
 
             elif type == "lrg": #register
-                if self.username != "" or self.address not in self.server.captchas or self.player is not None or self.pendingStat is None:
+                if self.username != "" or self.address not in self.server.captchas or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 self.stopDCTimer()
                 
                 username = packet["username"].upper()
+                def registered(result):
+                    status, msg, self.accountPriv = result
+                    if status:
+                        self.server.captchas.pop(self.address, None)
+                        self.account = msg
+                        self.username = username
+                        self.session = msg["session"]
+                        self.server.authd.add(self.username)
+                    self.sendJSON({"type": "lrg", "status": status, "msg": msg})
                 if CP_IMPORT and len(packet["captcha"]) != 5:
-                    status, msg = False, "invalid captcha"
+                    self.sendJSON({"type": "lrg", "status": False, "msg": "invalid captcha"})
                 elif CP_IMPORT and packet["captcha"].upper() != self.server.captchas[self.address]:
-                    status, msg = False, "incorrect captcha"
+                    self.sendJSON({"type": "lrg", "status": False, "msg": "incorrect captcha"})
                 elif util.checkCurse(username):
-                    status, msg = False, "please choose a different username"
+                    self.sendJSON({"type": "lrg", "status": False, "msg": "please choose a different username"})
                 else:
-                    status, msg, self.accountPriv = datastore.register(self.dbSession, username, packet["password"])
-
-                if status:
-                    del self.server.captchas[self.address]
-                    self.account = msg
-                    self.username = username
-                    self.session = msg["session"]
-                    self.server.authd.append(self.username)
-                self.sendJSON({"type": "lrg", "status": status, "msg": msg})
+                    self.dbCall(registered, datastore.register(username, packet["password"]))
 
             elif type == "lrc": #request captcha
-                if self.username != "" or self.player is not None or self.pendingStat is None:
+                if self.username != "" or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 if not CP_IMPORT:
@@ -356,50 +439,57 @@ class MyServerProtocol(WebSocketServerProtocol):
                 
 
             elif type == "lrs": #resume session
-                if self.username != "" or self.player is not None or self.pendingStat is None:
+                if self.username != "" or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 self.stopDCTimer()
                 
-                status, msg, self.accountPriv = datastore.resumeSession(self.dbSession, packet["session"])
-
-                j = {"type": "lrs", "status": status, "msg": msg}
-                if status:
-                    if msg["username"] in self.server.authd:
-                        self.sendJSON({"type": "lrs", "status": False, "msg": "account already in use"})
-                        return
-                    j["username"] = self.username = msg["username"]
-                    self.account = msg
-                    self.session = msg["session"]
-                    self.server.authd.append(self.username)
-                self.sendJSON(j)
+                def resumed(result):
+                    status, msg, self.accountPriv = result
+                    j = {"type": "lrs", "status": status, "msg": msg}
+                    if status:
+                        if msg["username"] in self.server.authd:
+                            self.sendJSON({"type": "lrs", "status": False, "msg": "account already in use"})
+                            return
+                        j["username"] = self.username = msg["username"]
+                        self.account = msg
+                        self.session = msg["session"]
+                        self.server.authd.add(self.username)
+                    self.sendJSON(j)
+                self.dbCall(resumed, datastore.defer(datastore.resumeSession, packet["session"]))
 
             elif type == "lpr": #update profile
-                if self.username == "" or self.player is not None or self.pendingStat is None:
+                if self.username == "" or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
                 
-                res = datastore.updateAccount(self.dbSession, self.username, packet)
-                j = {"type": "lpr", "status":res[0], "changes":res[1], "msg":res[2]}
-                self.sendJSON(j)
+                def updated(res):
+                    if res[0] and "nickname" in res[1]:
+                        self.server.leaderBoard.rename(self.accountPriv["id"], res[1]["nickname"])
+                    j = {"type": "lpr", "status":res[0], "changes":res[1], "msg":res[2]}
+                    self.sendJSON(j)
+                self.dbCall(updated, datastore.defer(datastore.updateAccount, self.username, packet))
 
             elif type == "lpc": #password change
-                if self.username == "" or self.player is not None or self.pendingStat is None:
+                if self.username == "" or self.player is not None or self.pendingStat is None or self.dbPending:
                     self.sendClose2()
                     return
 
-                datastore.changePassword(self.dbSession, self.username, packet["password"])
+                def changed(result):
+                    status, msg = result
+                    self.sendJSON({"type": "lpc", "status": status, "msg": msg})
+                self.dbCall(changed, datastore.changePassword(self.username, packet["password"]))
 
         elif self.stat == "g":
             if type == "g00": # Ingame state ready
                 if self.player is None or self.pendingStat is None:
                     if self.server.shuttingDown:
                         levelName, levelData = self.server.getRandomLevel("maintenance", None)
-                        self.sendJSON({"packets": [{"game": levelName, "levelData": json.dumps(levelData), "type": "g01"}], "type": "s01"})
+                        self.sendText(self.server.getRawLoadMsg(levelName, levelData))
                         return
                     if self.blocked:
                         levelName, levelData = self.server.getRandomLevel("jail", None)
-                        self.sendJSON({"packets": [{"game": levelName, "levelData": json.dumps(levelData), "type": "g01"}], "type": "s01"})
+                        self.sendText(self.server.getRawLoadMsg(levelName, levelData))
                         return
                     self.sendClose2()
                     return
@@ -410,7 +500,7 @@ class MyServerProtocol(WebSocketServerProtocol):
             elif type == "g03": # World load completed
                 if self.player is None:
                     if self.blocked or self.server.shuttingDown:
-                        self.sendBin(0x02, Buffer().writeInt16(0).writeInt16(0).writeInt8(0))
+                        self.sendBin(0x02, packets.encode(0x02, 0, 0, 0))
                         #self.startDCTimer(15)
                         return
                     self.sendClose2()
@@ -434,15 +524,20 @@ class MyServerProtocol(WebSocketServerProtocol):
                 
                 levelName = packet["name"]
                 if levelName == "custom":
-                    try:
-                        self.player.match.selectCustomLevel(packet["data"])
-                    except Exception as e:
-                        estr = str(e)
+                    player = self.player
+                    match = player.match
+                    def selected(lv):
+                        if self.player is not player or player.match is not match:
+                            return # left the match while the level was being validated
+                        match.selectCustomLevel(lv)
+                        self.sendJSON({"type":"gsl","name":levelName,"status":"success","message":""})
+                    def failed(failure):
+                        if self.player is not player:
+                            return
+                        estr = str(failure.value)
                         estr = "\n".join(estr.split("\n")[:10])
                         self.sendJSON({"type":"gsl","name":levelName,"status":"error","message":estr})
-                        return
-                    
-                    self.sendJSON({"type":"gsl","name":levelName,"status":"success","message":""})
+                    self.server.getCustomLevel(packet["data"]).addCallbacks(selected, failed)
                 else:
                     self.player.match.selectLevel(levelName)
             elif type == "gbn":  # ban player
@@ -468,29 +563,29 @@ class MyServerProtocol(WebSocketServerProtocol):
             else:
                 print("unknown message! "+payload)
 
-    def onBinaryMessage(self):
-        pktLenDict = { 0x10: 6, 0x11: 0, 0x12: 12, 0x13: 1, 0x17: 2, 0x18: 4, 0x19: 0, 0x20: 7, 0x30: 7 }
+    def onBinaryMessage(self, data):
+        # Walks every complete packet in data and returns the offset of the first byte not consumed
+        pos = 0
+        end = len(data)
+        while pos < end:
+            code = data[pos]
+            codec = packets.DECODERS.get(code)
+            if codec is None:
+                #print("Unknown binary message received: {1} = {0}".format(repr(data[pos+1:]), hex(code)))
+                return end
+
+            pktEnd = pos + 1 + codec.size
+            if pktEnd > end:
+                break
 
-        code = self.recv[0]
-        if code not in pktLenDict:
-            #print("Unknown binary message received: {1} = {0}".format(repr(self.recv[1:]), hex(code)))
-            self.recv.clear()
-            return False
-            
-        pktLen = pktLenDict[code] + 1
-        if len(self.recv) < pktLen:
-            return False
-        
-        b = Buffer(self.recv[1:pktLen])
-        del self.recv[:pktLen]
-        
-        if self.player is None or not self.player.loaded or self.blocked or (not self.player.match.closed and self.player.match.playing):
-            self.recv.clear()
-            return False
+            if self.player is None or not self.player.loaded or self.blocked or (not self.player.match.closed and self.player.match.playing):
+                return end
 
-        #print("Binary message received: code="+str(code)+", content:"+",".join([str(x) for x in b.toBytes()]));
-        self.player.handlePkt(code, b, b.toBytes())
-        return True
+            pktData = bytes(data[pos + 1:pktEnd])
+            #print("Binary message received: code="+str(code)+", content:"+",".join([str(x) for x in pktData]));
+            self.player.handlePkt(code, codec.unpack_from(data, pos + 1), pktData)
+            pos = pktEnd
+        return pos
 
 class MyServerFactory(WebSocketServerFactory):
 
@@ -503,9 +598,15 @@ class MyServerFactory(WebSocketServerFactory):
             self.levelsPath = ""
         self.fileHash = {}
         self.levels = {}
+        self.levelsLoading = {}  # level -> "loading", "again" (changed while loading) or "deleted"
+        self.levelsFailed = {}   # level -> mtime of the version that failed, so it isn't retried
+        self.levelsPolling = False
+        self.levelWatcher = None
+        self.customLevelCache = util.LRUCache(32)
         self.guestSkins = []
         self.ownLevels = False
         self.shuttingDown = False
+        self.matches = MatchDirectory(self)
         if not self.tryReloadFile(self.configFilePath, self.readConfig):
             sys.stderr.write("The file \"server.cfg\" does not exist or is invalid, consider renaming \"server.cfg.example\" to \"server.cfg\".\n")
             if os.name == 'nt': # Enforce that the window opens in windows
@@ -515,22 +616,32 @@ class MyServerFactory(WebSocketServerFactory):
         if self.levelsPath:
             self.ownLevels = True
             self.reloadLevels()
+            self.startLevelWatcher()
         if self.assetsMetadataPath:
             self.tryReloadFile(self.assetsMetadataPath, self.readAssetsMetadata)
-        if self.mysqlHost:
-            datastore.checkDb(self.mysqlHost, self.mysqlPort, self.mysqlUser, self.mysqlPass, self.mysqlDB)
+        datastore.startHashPool(self.hashWorkers, self.maxHashQueue)
+        if self.dbUrl:
+            datastore.openDb(self.dbUrl, self.dbPoolSize, self.dbPoolOverflow, self.dbPoolTimeout)
+        elif self.mysqlHost:
+            datastore.checkDb(self.mysqlHost, self.mysqlPort, self.mysqlUser, self.mysqlPass, self.mysqlDB, self.dbPoolSize, self.dbPoolOverflow, self.dbPoolTimeout)
+        datastore.openSessions(self.sessionStorePath, self.sessionTTL)
+        datastore.accountCache = datastore.AccountCache(self.accountCacheSize, self.accountCacheTTL)
+        task.LoopingCall(lambda: datastore.sweepSessions().addErrback(log.err)).start(self.sessionSweepInterval, now=False)
+        datastore.startPool(self.dbThreads)
+        self.stats = StatsBuffer(self.statsJournalPath, self.statsFlushInterval, self.statsFlushSize)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stats.stop)
+        reactor.addSystemEventTrigger("after", "shutdown", self.stats.close)
+        self.leaderBoard = LeaderBoard()
+        self.stats.onFlushed.append(self.leaderBoard.update)
 
         WebSocketServerFactory.__init__(self, url.format(self.listenPort))
 
-        self.players = list()
-        self.matches = list()
+        self.players = dict()   # insertion ordered, for O(1) removal
+        self.addressCounts = Counter()
         
-        self.blocked = list()
-        try:
-            with open(self.blockedFilePath, "r") as f:
-                self.blocked = json.loads(f.read())
-        except:
-            pass
+        self.blocked = BanList()
+        self.blockedFileData = None
+        self.readBlocked()
 
         if DWH_IMPORT:
             self.discordWebhook = DiscordWebhook(url=self.discordWebhookUrl)
@@ -540,13 +651,23 @@ class MyServerFactory(WebSocketServerFactory):
         self.randomWorldList = dict()
 
         self.maxLoginTries = {}
-        self.loginBlocked = []
+        self.loginBlocked = util.ExpiringSet(60)
         self.captchas = {}
-        self.authd = []
+        self.authd = set()
 
         self.in_messages = 0
         self.out_messages = 0
 
+        self.pendingOutboxes = []
+        self.outboxTimer = None
+        self.updateOutboxTimer()
+
+        self.compressCache = util.LRUCache(64)
+        self.compressIn = 0
+        self.compressOut = 0
+        self.compressTime = 0.0
+        self.compressHits = 0
+
         reactor.callLater(5, self.generalUpdate)
 
         l = task.LoopingCall(self.updateLeaderBoard)
@@ -554,29 +675,125 @@ class MyServerFactory(WebSocketServerFactory):
 
     def updateLeaderBoard(self):
         if self.leaderBoardPath != '':
-            print("updating leader board at "+self.leaderBoardPath)
-            leaderBoard = datastore.getLeaderBoard()
-            with open(self.leaderBoardPath, "w") as f:
-                f.write(json.dumps(leaderBoard))
+            seeds = []
+            for metric in list(self.leaderBoard.stale):
+                self.leaderBoard.seeding(metric)
+                d = datastore.defer(datastore.getTopAccounts, metric, self.leaderBoard.size)
+                seeds.append(d.addCallback(lambda rows, metric=metric: self.leaderBoard.seed(metric, rows)))
+            def write(result):
+                if not self.leaderBoard.changed:
+                    return
+                print("updating leader board at "+self.leaderBoardPath)
+                tmpPath = self.leaderBoardPath + ".tmp"
+                with open(tmpPath, "w") as f:
+                    f.write(json.dumps(self.leaderBoard.toJSON()))
+                os.replace(tmpPath, self.leaderBoardPath)
+                self.leaderBoard.changed = False
+            defer.gatherResults(seeds, consumeErrors=True).addCallback(write).addErrback(log.err)
         if self.debugMemoryLeak:
             objgraph.show_growth(limit=50)
             [objgraph.show_backrefs(x,filename="debug/refs"+str(i)+".dot") for i,x in enumerate(objgraph.by_type("Match"))]
 
-    def reloadLevel(self, level):
+    def loadLevelFile(self, level):
+        # Doesn't touch any server state, so it can run in a worker thread
         fullPath = os.path.join(self.levelsPath, level)
+        mtime = os.stat(fullPath).st_mtime
+        with open(fullPath, "r", encoding="utf-8-sig") as f:
+            content = f.read()
+        return parseLevel(content, mtime)
+
+    def publishLevel(self, lv, level):
+        isNew = not level in self.levels
+        self.levels[level] = lv
+        self.levelsFailed.pop(level, None)
+        print(level+" "+ ("loaded" if isNew else "reloaded") +".")
+
+    def reloadLevel(self, level):
         try:
-            with open(fullPath, "r", encoding="utf-8-sig") as f:
-                content = f.read()
-                lk = json.loads(content)
-                util.validateLevel(lk)
-                lk["mtime"] = os.stat(fullPath).st_mtime
-                isNew = not level in self.levels
-                self.levels[level] = lk
-                print(level+" "+ ("loaded" if isNew else "reloaded") +".")
+            self.publishLevel(self.loadLevelFile(level), level)
         except:
             print("error while loading "+level+":")
             raise
 
+    def reloadLevelAsync(self, level, mtime=None):
+        # Reading, validating and indexing happen in a worker thread. The new Level is then
+        # swapped into self.levels on the reactor thread, if it fails the old one stays.
+        if level in self.levelsLoading:
+            self.levelsLoading[level] = "again"
+            return
+        self.levelsLoading[level] = "loading"
+        def loaded(lv):
+            if self.levelsLoading[level] != "deleted":
+                self.publishLevel(lv, level)
+        def failed(failure):
+            print("error while loading "+level+":")
+            print(failure.getTraceback())
+            if mtime is not None:
+                self.levelsFailed[level] = mtime
+        def done(result):
+            if self.levelsLoading.pop(level) == "again":
+                self.reloadLevelAsync(level)
+        d = threads.deferToThread(self.loadLevelFile, level)
+        d.addCallbacks(loaded, failed)
+        d.addBoth(done)
+
+    def forgetLevel(self, level):
+        if level in self.levelsLoading:
+            self.levelsLoading[level] = "deleted"
+        self.levelsFailed.pop(level, None)
+        if level in self.levels:
+            del self.levels[level]
+            print(level+" deleted")
+
+    def scanLevels(self):
+        mtimes = {}
+        for entry in os.scandir(self.levelsPath):
+            if entry.is_file():
+                mtimes[entry.name] = entry.stat().st_mtime
+        return mtimes
+
+    def checkLevels(self, mtimes):
+        for f in set(self.levels.keys())-set(mtimes):
+            self.forgetLevel(f)
+        for f in sorted(mtimes):
+            mtime = mtimes[f]
+            if self.levelsFailed.get(f) == mtime:
+                continue
+            if not f in self.levels or mtime > self.levels[f].mtime:
+                self.reloadLevelAsync(f, mtime)
+
+    def pollLevels(self):
+        # Fallback when inotify isn't available, the directory is scanned in a worker thread too
+        if self.levelsPolling:
+            return
+        self.levelsPolling = True
+        def done(result):
+            self.levelsPolling = False
+            return result
+        d = threads.deferToThread(self.scanLevels)
+        d.addBoth(done)
+        d.addCallbacks(self.checkLevels, lambda failure: print(failure.getTraceback()))
+
+    def startLevelWatcher(self):
+        if not INOTIFY_IMPORT:
+            return
+        try:
+            watcher = inotify.INotify()
+            watcher.startReading()
+            mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE
+            watcher.watch(filepath.FilePath(self.levelsPath), mask, callbacks=[self.onLevelFileEvent])
+            self.levelWatcher = watcher
+        except Exception as e:
+            print("Can't watch the levels directory, falling back to polling: "+str(e))
+
+    def onLevelFileEvent(self, ignored, path, mask):
+        level = path.basename()
+        if isinstance(level, bytes):
+            level = level.decode('utf-8')
+        if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.forgetLevel(level)
+        elif path.isfile():
+            self.reloadLevelAsync(level)
 
     def reloadLevels(self):
         files = os.listdir(self.levelsPath)
@@ -587,7 +804,7 @@ class MyServerFactory(WebSocketServerFactory):
             print(f+" deleted")
         newLevels = set(files)-set(self.levels.keys())
         for f in self.levels.keys(): #we do this first so levels only contains the still-existing levels
-            oldMt = self.levels[f]["mtime"]
+            oldMt = self.levels[f].mtime
             newMt = os.stat(os.path.join(self.levelsPath, f)).st_mtime
             if (newMt>oldMt):
                 self.reloadLevel(f)
@@ -626,6 +843,10 @@ class MyServerFactory(WebSocketServerFactory):
         self.defaultName = config.get('Server', 'DefaultName').strip()
         self.defaultTeam = config.get('Server', 'DefaultTeam').strip()
         self.maxSimulIP = config.getint('Server', 'MaxSimulIP')
+        self.binaryBatchInterval = config.getint('Server', 'BinaryBatchInterval', fallback=0)
+        self.compression = config.getboolean('Server', 'Compression', fallback=False)
+        self.compressionThreshold = config.getint('Server', 'CompressionThreshold', fallback=1024)
+        self.compressionLevel = config.getint('Server', 'CompressionLevel', fallback=6)
         if not self.assetsMetadataPath:
             self.skinCount = config.getint('Server', 'SkinCount')
         self.discordWebhookUrl = config.get('Server', 'DiscordWebhookUrl').strip()
@@ -634,9 +855,25 @@ class MyServerFactory(WebSocketServerFactory):
         self.mysqlUser = config.get('Server', 'MySqlUser')
         self.mysqlPass = config.get('Server', 'MySqlPass')
         self.mysqlDB = config.get('Server', 'MySqlDB')
+        self.dbUrl = config.get('Server', 'DbUrl', fallback='').strip()
+        self.dbThreads = config.getint('Server', 'DbThreads', fallback=8)
+        self.dbPoolSize = config.getint('Server', 'DbPoolSize', fallback=8)
+        self.dbPoolOverflow = config.getint('Server', 'DbPoolOverflow', fallback=4)
+        self.dbPoolTimeout = config.getfloat('Server', 'DbPoolTimeout', fallback=10.0)
+        self.hashWorkers = config.getint('Server', 'HashWorkers', fallback=0)
+        self.maxHashQueue = config.getint('Server', 'MaxHashQueue', fallback=64)
+        self.statsFlushInterval = config.getfloat('Server', 'StatsFlushInterval', fallback=10.0)
+        self.statsFlushSize = config.getint('Server', 'StatsFlushSize', fallback=200)
+        self.statsJournalPath = config.get('Server', 'StatsJournal', fallback="stats.journal")
+        self.sessionStorePath = config.get('Server', 'SessionStore', fallback="sessions.db")
+        self.sessionTTL = config.getint('Server', 'SessionTTL', fallback=604800)
+        self.sessionSweepInterval = config.getint('Server', 'SessionSweepInterval', fallback=600)
+        self.accountCacheSize = config.getint('Server', 'AccountCacheSize', fallback=10000)
+        self.accountCacheTTL = config.getint('Server', 'AccountCacheTTL', fallback=60)
         self.debugMemoryLeak = config.getint('Server', 'debugMemoryLeak', fallback=0)
         self.restrictPublicSkins = config.getboolean('Server', 'restrictPublicSkins', fallback=False)
         self.banPowerUpInLobby = config.getboolean('Server', 'banPowerUpInLobby', fallback=False)
+        self.maxCustomLevelSize = config.getint('Server', 'MaxCustomLevelSize', fallback=4194304)
         if self.debugMemoryLeak:
             if not os.path.exists("debug"):
                 os.mkdir("debug")
@@ -661,6 +898,10 @@ class MyServerFactory(WebSocketServerFactory):
         self.enableVoteStart = config.getboolean('Match', 'EnableVoteStart')
         self.voteRateToStart = config.getfloat('Match', 'VoteRateToStart')
         self.allowLateEnter = config.getboolean('Match', 'AllowLateEnter')
+        self.matches.refresh()
+        self.interestRadius = config.getint('Match', 'InterestRadius', fallback=0)
+        self.interestFarRate = config.getint('Match', 'InterestFarRate', fallback=0)
+        self.playerListDeltas = config.getboolean('Match', 'PlayerListDeltas', fallback=False)
         self.coinRewardFlagpole = config.getint('Match', 'coinRewardFlagpole', fallback=500)
         self.coinRewardPodium1 = config.getint('Match', 'coinRewardPodium1', fallback=200)
         self.coinRewardPodium2 = config.getint('Match', 'coinRewardPodium2', fallback=100)
@@ -684,29 +925,45 @@ class MyServerFactory(WebSocketServerFactory):
         print("pc: {0}, mc: {1}, in: {2}, out: {3}".format(playerCount, len(self.matches), self.in_messages, self.out_messages))
         self.in_messages = 0
         self.out_messages = 0
+        if self.compressIn:
+            print("deflate: {0} -> {1} bytes ({2} saved), {3:.1f} ms cpu, {4} cache hits".format(self.compressIn, self.compressOut, self.compressIn - self.compressOut, self.compressTime * 1000, self.compressHits))
+            self.compressIn = 0
+            self.compressOut = 0
+            self.compressTime = 0.0
+            self.compressHits = 0
+        dbPool = datastore.takePoolStats()
+        if dbPool["checkouts"] or dbPool["timeouts"]:
+            msg = "db pool: {0} checkouts, {1:.1f} ms avg wait, {2:.1f} ms max, {3} timeouts".format(
+                dbPool["checkouts"], dbPool["wait"] * 1000 / max(1, dbPool["checkouts"]), dbPool["maxWait"] * 1000, dbPool["timeouts"])
+            if dbPool["capacity"] is not None:
+                msg += ", peak {0} of {1} connections".format(dbPool["peak"], dbPool["capacity"])
+            print(msg)
+        accounts = datastore.accountCache
+        if accounts.hits or accounts.misses:
+            print("account cache: {0} hits, {1} misses, {2} cached".format(accounts.hits, accounts.misses, len(accounts)))
+            accounts.hits = 0
+            accounts.misses = 0
+        if self.stats.flushes:
+            print("stats: {0} rows in {1} flushes, {2} pending".format(self.stats.rowsFlushed, self.stats.flushes, len(self.stats.pending)))
+            self.stats.flushes = 0
+            self.stats.rowsFlushed = 0
 
         self.tryReloadFile(self.configFilePath, self.readConfig)
+        self.updateOutboxTimer()
         if self.assetsMetadataPath:
             self.tryReloadFile(self.assetsMetadataPath, self.readAssetsMetadata)
-        # Just to keep self.blocked synchronized with blocked.json
-        try:
-            with open(self.blockedFilePath, "r") as f:
-                self.blocked = json.loads(f.read())
-        except:
-            pass
+        self.readBlocked()
 
-        if self.levelsPath:
-            try:
-                self.reloadLevels()
-            except:
-                traceback.print_exc()
+        if self.levelsPath and self.levelWatcher is None:
+            self.pollLevels()
 
         if os.path.exists(self.shutdownFilePath):
             self.shuttingDown = True
             print("shutting down...")
             os.remove(self.shutdownFilePath)
+            msg = util.encodeJSON({"type":"ghu", "time": 180})
             for player in self.players:
-                player.hurryUp(180)
+                player.hurryUp(180, msg)
             reactor.callLater(240, self.shutdown)
 
         if self.statusPath:
@@ -724,50 +981,146 @@ class MyServerFactory(WebSocketServerFactory):
     def shutdown(self):
         reactor.stop()
 
+    def updateOutboxTimer(self):
+        interval = self.binaryBatchInterval / 1000.0
+        if self.outboxTimer is not None:
+            if self.outboxTimer.interval == interval:
+                return
+            self.outboxTimer.stop()
+            self.outboxTimer = None
+            self.flushOutboxes()
+        if interval > 0:
+            self.outboxTimer = task.LoopingCall(self.flushOutboxes)
+            self.outboxTimer.start(interval, now=False)
+
+    def flushOutboxes(self):
+        pending = self.pendingOutboxes
+        self.pendingOutboxes = []
+        for client in pending:
+            try:
+                client.flushOutbox()
+            except:
+                traceback.print_exc()
+
+    def acceptCompression(self, offers):
+        if not self.compression:
+            return None
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                # no context takeover keeps compressed messages independent of each other,
+                # which is what lets compressPayload share them between clients
+                return PerMessageDeflateOfferAccept(offer, no_context_takeover=True)
+        return None
+
+    def compressPayload(self, payload, windowBits, memLevel):
+        # payloads are keyed by identity: level loads are cached on their Level and
+        # broadcasts hand the very same bytes object to every recipient
+        key = (id(payload), windowBits, memLevel)
+        entry = self.compressCache.get(key)
+        if entry is not None and entry[0] is payload:
+            self.compressHits += 1
+            return entry[1]
+        start = time.perf_counter()
+        compressor = zlib.compressobj(self.compressionLevel, zlib.DEFLATED, -windowBits, memLevel)
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-4]
+        self.compressTime += time.perf_counter() - start
+        self.compressIn += len(payload)
+        self.compressOut += len(data)
+        self.compressCache.put(key, (payload, data))
+        return data
+
+    def readBlocked(self):
+        # Just to keep self.blocked synchronized with blocked.json, only rebuilt when the file changed
+        try:
+            with open(self.blockedFilePath, "r") as f:
+                data = f.read()
+            if data != self.blockedFileData:
+                self.blocked = BanList(json.loads(data))
+                self.blockedFileData = data
+        except:
+            pass
+
     def blockAddress(self, address, playerName, reason):
         if not address in self.blocked:
-            self.blocked.append([address, playerName, reason])
+            self.blocked.add([address, playerName, reason])
             try:
+                data = json.dumps(self.blocked.toList())
                 with open(self.blockedFilePath, "w") as f:
-                    f.write(json.dumps(self.blocked))
+                    f.write(data)
+                self.blockedFileData = data
             except:
                 pass
 
+    def addPlayer(self, player):
+        self.players[player] = None
+        self.addressCounts[player.client.address] += 1
+
+    def removePlayer(self, player):
+        if player not in self.players:
+            return
+        del self.players[player]
+        address = player.client.address
+        self.addressCounts[address] -= 1
+        if self.addressCounts[address] <= 0:
+            del self.addressCounts[address]
+
     def getPlayerCountByAddress(self, address):
-        count = 0
-        for player in self.players:
-            if player.client.address == address:
-                count += 1
-        return count
+        return self.addressCounts[address]
 
     def buildProtocol(self, addr):
         protocol = MyServerProtocol(self)
         protocol.factory = self
         return protocol
 
+    def banAccount(self, accId):
+        # Bans skip the stats buffer, so a banned account can't log in again before the next
+        # flush. If the write fails the buffer retries it.
+        def failed(failure):
+            log.err(failure, "ban of account {0} not written".format(accId))
+            self.stats.add(accId, {"isBanned": True})
+        datastore.defer(datastore.banAccount, accId).addErrback(failed)
+
     def getMatch(self, roomName, private, gameMode):
         if private and roomName == "":
             return Match(self, roomName, private, gameMode)
         
-        fmatch = None
-        for match in self.matches:
-            if not match.closed and len(match.players) < self.playerCap and gameMode == match.gameMode and private == match.private and (not private or match.roomName == roomName):
-                if not self.allowLateEnter and match.playing:
-                    continue
-                fmatch = match
-                break
-
+        fmatch = self.matches.find(roomName, private, gameMode)
         if fmatch == None:
             fmatch = Match(self, roomName, private, gameMode)
-            self.matches.append(fmatch)
+            self.matches.add(fmatch)
 
         return fmatch
 
     def removeMatch(self, match):
-        if match in self.matches:
-            self.matches.remove(match)
+        self.matches.remove(match)
+
+    def updateMatch(self, match):
+        self.matches.update(match)
                 
 
+    def getRawLoadMsg(self, levelName, levelData):
+        if not self.ownLevels:
+            return util.encodeJSON({"packets": [{"game": levelName, "levelData": json.dumps(levelData), "type": "g01"}], "type": "s01"})
+        encode = lambda: util.encodeJSON({"packets": [{"game": levelName, "levelData": json.dumps(levelData.toJSON()), "type": "g01"}], "type": "s01"})
+        return levelData.getLoadMsg("raw", encode)
+
+    def getCustomLevel(self, data):
+        # Uploads are validated in a worker thread. Levels are immutable once built, so
+        # the same upload gets the same Level back from the cache.
+        if not isinstance(data, str):
+            return defer.fail(Exception("invalid level data"))
+        if self.maxCustomLevelSize and len(data) > self.maxCustomLevelSize:
+            return defer.fail(Exception("level too large ({0} bytes, limit is {1})".format(len(data), self.maxCustomLevelSize)))
+        key = hashlib.sha256(data.encode('utf-8')).digest()
+        lv = self.customLevelCache.get(key)
+        if lv is not None:
+            return defer.succeed(lv)
+        def validated(lv):
+            self.customLevelCache.put(key, lv)
+            return lv
+        return threads.deferToThread(parseLevel, data).addCallback(validated)
+
     def getLevel(self, level):
         if not self.ownLevels:
             return (level, "")
@@ -775,9 +1128,9 @@ class MyServerFactory(WebSocketServerFactory):
             return ("custom", self.levels[level])
 
     def getLevelList(self, type, mode):
-        possibleLevels = [x for x in self.levels if self.levels[x]["type"] == type]
+        possibleLevels = [x for x in self.levels if self.levels[x].type == type]
         if mode is not None:
-            possibleLevels = [x for x in possibleLevels if self.levels[x]["mode"] == mode]
+            possibleLevels = [x for x in possibleLevels if self.levels[x].mode == mode]
         if len(possibleLevels) == 0:
             raise Exception("no levels match type: {} mode: {}".format(type, mode))
         return possibleLevels
@@ -805,7 +1158,7 @@ class MyServerFactory(WebSocketServerFactory):
 
 if __name__ == '__main__':
     factory = MyServerFactory(u"ws://127.0.0.1:{0}/royale/ws")
-    factory.setProtocolOptions(autoPingInterval=5, autoPingTimeout=5)
+    factory.setProtocolOptions(autoPingInterval=5, autoPingTimeout=5, perMessageCompressionAccept=factory.acceptCompression)
 
     reactor.listenTCP(factory.listenPort, factory)
     reactor.run()
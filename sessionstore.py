@@ -0,0 +1,76 @@
+import time
+import sqlite3
+import hashlib
+import secrets
+import threading
+
+class SessionStore(object):
+    # Login session tokens, kept as sha256 hashes in a sqlite file so they survive a restart
+    # and can be shared by several servers on one host. A dict in front answers the lookups,
+    # misses go to the file for sessions made by another process. Sessions expire ttl
+    # seconds after they were last used and sweep() drops the expired ones. Every call
+    # touches the file, so they all run on the datastore threads, hence the lock.
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (tokenHash TEXT PRIMARY KEY, username TEXT NOT NULL, expires REAL NOT NULL)")
+        self.sessions = {}  # token hash -> [username, expires]
+        now = time.time()
+        for tokenHash, username, expires in self.db.execute("SELECT tokenHash, username, expires FROM sessions WHERE expires >= ?", (now,)):
+            self.sessions[tokenHash] = [username, expires]
+
+    def create(self, username):
+        token = secrets.token_urlsafe(32)
+        tokenHash = hashToken(token)
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (tokenHash, username, expires))
+            self.sessions[tokenHash] = [username, expires]
+        return token
+
+    def get(self, token):
+        # Returns the username of a live session and extends it, None otherwise
+        tokenHash = hashToken(token)
+        now = time.time()
+        with self.lock:
+            entry = self.sessions.get(tokenHash)
+            if entry is None or entry[1] < now:
+                # unknown here, or maybe extended by another process since
+                row = self.db.execute("SELECT username, expires FROM sessions WHERE tokenHash = ?", (tokenHash,)).fetchone()
+                if row is None or row[1] < now:
+                    self.sessions.pop(tokenHash, None)
+                    return None
+                entry = self.sessions[tokenHash] = list(row)
+            if self.db.execute("UPDATE sessions SET expires = ? WHERE tokenHash = ?", (now + self.ttl, tokenHash)).rowcount == 0:
+                # logged out by another process
+                del self.sessions[tokenHash]
+                return None
+            entry[1] = now + self.ttl
+            return entry[0]
+
+    def delete(self, token):
+        tokenHash = hashToken(token)
+        with self.lock:
+            self.sessions.pop(tokenHash, None)
+            self.db.execute("DELETE FROM sessions WHERE tokenHash = ?", (tokenHash,))
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+            for tokenHash in [k for k, v in self.sessions.items() if v[1] < now]:
+                del self.sessions[tokenHash]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def hashToken(token):
+    return hashlib.sha256(str(token).encode('utf-8')).hexdigest()
@@ -0,0 +1,144 @@
+import os
+import json
+import uuid
+import datastore
+from twisted.internet import task, defer
+from twisted.python import log
+
+COUNTERS = ("wins", "deaths", "kills", "coins")
+
+def mergeStats(into, fields):
+    for key, value in fields.items():
+        if key == "coins":
+            # Coins are clamped at 0 after every change. max(floor, coins + sum) covers any
+            # run of changes: the sum of the deltas, and the floor the last clamp leaves.
+            floor = fields.get("coinsFloor", 0)
+            if "coins" in into:
+                floor = max(floor, into["coinsFloor"] + value)
+            into["coinsFloor"] = floor
+            into["coins"] = into.get("coins", 0) + value
+        elif key in COUNTERS:
+            into[key] = into.get(key, 0) + value
+        elif key != "coinsFloor":
+            into[key] = value
+    return into
+
+class StatsBuffer(object):
+    # Write-behind buffer for the stats changes of disconnecting accounts. Changes are
+    # merged per account id and written in one transaction every interval seconds, or as
+    # soon as maxPending accounts are waiting. Each batch gets an id and stays in the
+    # journal file until the database has it, and whatever is still buffered when the
+    # reactor stops goes there too; both are loaded back on the next start. The database
+    # records the ids it has written, so a batch is never added twice.
+    def __init__(self, journalPath, interval, maxPending, clock=None):
+        self.journalPath = journalPath
+        self.maxPending = maxPending
+        self.pending = {}   # account id -> merged fields
+        self.batches = []   # [batch id, {account id -> fields}] journaled, the first one is being written
+        self.flushing = None
+        self.flushes = 0
+        self.rowsFlushed = 0
+        self.onFlushed = []     # called with the new totals of the accounts written
+        self.readJournal()
+        self.timer = task.LoopingCall(self.flush)
+        if clock is not None:
+            self.timer.clock = clock
+        self.timer.start(interval, now=False)
+
+    def add(self, accId, fields):
+        mergeStats(self.pending.setdefault(accId, {}), fields)
+        if len(self.pending) >= self.maxPending:
+            self.flush()
+
+    def flush(self):
+        # Batches left from a failed flush or the last run go first, as they were. The
+        # journal is written in the datastore pool too, and only from within the flush, so
+        # two writes never race.
+        if self.flushing is not None or not (self.batches or self.pending):
+            return defer.succeed(None)
+        d = defer.succeed(None)
+        if not self.batches:
+            self.batches.append([uuid.uuid4().hex, self.pending])
+            self.pending = {}
+            d = self.saveJournal()
+        batchId, batch = self.batches[0]
+        def done(result):
+            failed, totals = result
+            self.flushes += 1
+            self.rowsFlushed += len(batch) - len(failed)
+            if failed:
+                print("{0} stats rows not written, retrying later".format(len(failed)))
+                self.batches[0][1] = failed
+            else:
+                del self.batches[0]
+            for callback in self.onFlushed:
+                callback(totals)
+            d = self.saveJournal()
+            if not failed:
+                d.addCallback(lambda result: datastore.defer(datastore.forgetStatsBatch, batchId))
+            return d
+        def error(failure):
+            log.err(failure, "stats flush failed")
+        def finished(result):
+            self.flushing = None
+        d.addCallback(lambda result: datastore.defer(datastore.flushStats, batch, batchId))
+        d.addCallbacks(done, error).addErrback(log.err).addBoth(finished)
+        self.flushing = d
+        return d
+
+    def stop(self):
+        # "before" shutdown trigger, the reactor waits for the last flushes
+        if self.timer.running:
+            self.timer.stop()
+        d = self.flushing if self.flushing is not None else defer.succeed(None)
+        for i in range(len(self.batches) + 1):
+            d.addCallback(lambda result: self.flush())
+        return d
+
+    def close(self):
+        # "after" shutdown trigger, the database pool is gone by now
+        writeJournal(self.journalPath, self.journalEntries(self.pending))
+
+    def readJournal(self):
+        try:
+            with open(self.journalPath, "r") as f:
+                entries = json.loads(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print("can't read stats journal {0}: {1}".format(self.journalPath, e))
+            return
+        count = 0
+        for entry in entries:
+            # a batch without id was never sent to the database
+            rows = {}
+            for accId, fields in entry["rows"]:
+                mergeStats(rows.setdefault(accId, {}), fields)
+            if entry["batch"] is None:
+                for accId, fields in rows.items():
+                    mergeStats(self.pending.setdefault(accId, {}), fields)
+            else:
+                self.batches.append([entry["batch"], rows])
+            count += len(rows)
+        print("{0} stats rows loaded from {1}".format(count, self.journalPath))
+
+    def journalEntries(self, pending=None):
+        entries = [{"batch": batchId, "rows": list(rows.items())} for batchId, rows in self.batches]
+        if pending:
+            entries.append({"batch": None, "rows": list(pending.items())})
+        return entries
+
+    def saveJournal(self):
+        return datastore.deferCall(writeJournal, self.journalPath, self.journalEntries())
+
+def writeJournal(path, entries):
+    if not entries:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "w") as f:
+        f.write(json.dumps(entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
@@ -1,8 +1,14 @@
 import os
 import json
 import jsonschema
+from collections import OrderedDict
+from twisted.internet import task
 
 levelJsonSchema = json.loads(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "levelSchema.json"), "r").read())
+# built once, jsonschema.validate would check the schema and create a new validator on every call
+levelValidatorClass = jsonschema.validators.validator_for(levelJsonSchema)
+levelValidatorClass.check_schema(levelJsonSchema)
+levelValidator = levelValidatorClass(levelJsonSchema)
 
 curse = []
 cursePath=os.path.join(os.path.dirname(os.path.abspath(__file__)),"words.json")
@@ -10,6 +16,77 @@ if os.path.exists(cursePath):
     with open(cursePath, "r") as f:
         curse = json.loads(f.read())
 
+def encodeJSON(j):
+    return json.dumps(j).encode('utf-8')
+
+class LRUCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def __len__(self):
+        return len(self.entries)
+
+class ExpiringSet:
+    # A set whose members drop out ttl seconds after being added. Expiry is kept in a timer
+    # wheel ticked by a single LoopingCall rather than one callLater per member.
+    def __init__(self, ttl, resolution=1, clock=None):
+        self.members = {}   # member -> wheel slot
+        self.slots = [set() for i in range(max(1, int(-(-ttl // resolution))))]
+        self.cursor = 0
+        # withCount, so ticks missed while the reactor was busy are still counted
+        self.timer = task.LoopingCall.withCount(self.tick)
+        if clock is not None:
+            self.timer.clock = clock
+        self.timer.start(resolution, now=False)
+
+    def add(self, member):
+        self.discard(member)
+        self.slots[self.cursor].add(member)
+        self.members[member] = self.cursor
+
+    def discard(self, member):
+        slot = self.members.pop(member, None)
+        if slot is not None:
+            self.slots[slot].discard(member)
+
+    def tick(self, count=1):
+        for i in range(min(count, len(self.slots))):
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            expired = self.slots[self.cursor]
+            if expired:
+                for member in expired:
+                    del self.members[member]
+                self.slots[self.cursor] = set()
+        if count > len(self.slots):
+            self.cursor = (self.cursor + count - len(self.slots)) % len(self.slots)
+
+    def stop(self):
+        if self.timer.running:
+            self.timer.stop()
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def __len__(self):
+        return len(self.members)
+
 def leet2(word):
     REPLACE = { str(index): str(letter) for index, letter in enumerate('oizeasgtb') }
     letters = [ REPLACE.get(l, l) for l in word.lower() ]
@@ -44,12 +121,26 @@ def checkCheckCurse(name, blacklist):
 def validateLevel(lk):
     good = True
     s = []
-    try:
-        jsonschema.validate(instance=lk, schema=levelJsonSchema)
-    except Exception as e:
+    e = jsonschema.exceptions.best_match(levelValidator.iter_errors(lk))
+    if e is not None:
         good = False
         s=str(e).split("\n")
         if 10<len(s):
             s = s[:5]+["..."]+s[-5:]
     if not good:
         raise Exception("\n".join(s))
+    # main layer tiles are kept in flat uint32 arrays, so that layer has to be a proper
+    # rectangle; other layers are only passed on to clients
+    from level import extractMainLayer
+    for world in lk["world"]:
+        for zone in world["zone"]:
+            data = extractMainLayer(zone)["data"]
+            if len(data) == 0 or len(data[0]) == 0:
+                raise Exception("invalid level - zone {0} in world {1} has no tiles".format(zone["id"], world["id"]))
+            width = len(data[0])
+            for row in data:
+                if len(row) != width:
+                    raise Exception("invalid level - rows of zone {0} in world {1} differ in length".format(zone["id"], world["id"]))
+                for tile in row:
+                    if tile < 0 or tile > 0xFFFFFFFF:
+                        raise Exception("invalid level - tile {0} in zone {1} of world {2} is out of range".format(tile, zone["id"], world["id"]))